@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 import ast
 import asyncio
+import contextvars
+import functools
+import gzip
+import hashlib
 import json
 import os
 import re
 import sys
 import threading
 import logging
+import weakref
+from io import StringIO
 
+import aiofiles
 import aiosqlite
 import pandas as pd
 from dotenv import load_dotenv, find_dotenv
@@ -15,8 +22,6 @@ from typing import Dict, Any, List, Optional
 
 # Langchain/Langgraph Imports
 from langchain_core.messages import ToolMessage, HumanMessage, AIMessage # Added AIMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import AzureChatOpenAI
 from langgraph.prebuilt import create_react_agent
 from typing_extensions import TypedDict
 from pathlib import Path
@@ -27,9 +32,9 @@ from langgraph.graph import StateGraph
 from textwrap import dedent
 from langchain_experimental.tools import PythonREPLTool
 
-# MCP Imports
-from langchain_mcp_adapters.tools import load_mcp_tools
-from mcp import ClientSession, StdioServerParameters, stdio_client
+# Provider SDKs (langchain_openai / langchain_google_genai) and the MCP client
+# packages are imported lazily where they are first used, so only the
+# configured provider is loaded.
 
 from src.prompts.graph_prompts import GraphPromptGenerator
 from src.agents.CMA_Customer_Alerts import FinancialDataExtractor
@@ -55,11 +60,115 @@ if not all([AZURE_API_KEY, AZURE_ENDPOINT, AZURE_API_VERSION]):
 if not GOOGLE_API_KEY:
      logging.warning("Google API key environment variable might be missing.")
 
+# MCP tools whose names start with these prefixes are read-only and may run concurrently
+CONCURRENCY_SAFE_TOOL_PREFIXES = ("read_", "list_", "get_", "calculate_")
+
+# System prompt for the data formatting chain; the template and sheet data are filled per call
+DATA_FORMAT_SYSTEM_PROMPT = dedent(
+    """
+    You are an intelligent data extraction assistant. Your task is to analyze and understand the provided data, extract the data in the below format. 
+    {{{data_format_template}}}
+
+    Output must be in the above format only. Produce a clean output without any ```json or ```python or ```.
+    If you are unable to find any value, put 0 respectively. Values should be Numeric. Modify the date in same format (DD-MM-YYYY).
+    """
+)
+
+# Static instructions for the cumulative report. Kept byte-identical across runs (the account
+# and insights go in the human message) so provider-side prefix caching can reuse it.
+CUMULATIVE_REPORT_SYSTEM_PROMPT = dedent(
+    """
+    You are a financial analyst assistant. You have received individual analysis reports for different sections (sheets) of a financial dataset (like a CMA report). Your task is to synthesize these reports into a single, cohesive cumulative report.
+    Structure the report logically:
+    1.  **Introduction:** Briefly state the purpose (e.g., summary of CMA analysis for the account) and list the sections analyzed.
+    2.  **Section Summaries:** For each analyzed section (sheet name), provide a concise summary of its key findings based on the input provided below. Use the sheet names as headings (e.g., `## Balance Sheet`).
+    3.  **Overall Conclusion/Key Takeaways:** Provide a high-level summary synthesizing the findings across all sections. Highlight any major trends, risks, or important points derived from the combined analysis.
+
+    Ensure the output is clean Markdown.
+    Final output should be without ```markdown and ```.
+    """
+)
+
+# Map step for oversized section analyses; condensed before they go into the cumulative prompt
+INSIGHT_CONDENSE_SYSTEM_PROMPT = dedent(
+    """
+    You are a financial analyst assistant. Condense the section analysis provided below into concise Markdown bullet points of roughly {target_tokens} tokens or fewer.
+    Keep every key figure, ratio, trend, risk and conclusion; drop repetition and filler.
+    Output only the bullet points, without ```markdown and ```.
+    """
+)
+
+
+
+class _SharedMCPSession:
+    """
+    An MCP stdio client and session shared by analyzers (config "mcp_reuse_session").
+    A dedicated owner task enters and exits both contexts, because anyio cancel scopes must be exited
+    in the task that entered them; analyzers only borrow the session.
+    """
+
+    def __init__(self, server_params):
+        self.session = None
+        self.ref_count = 0
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._error: Optional[BaseException] = None
+        self._task = asyncio.create_task(self._own(server_params))
+
+    async def _own(self, server_params):
+        from mcp import ClientSession, stdio_client
+        try:
+            async with stdio_client(server_params) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    self.session = session
+                    self._ready.set()
+                    await self._stop.wait()
+        except Exception as e:
+            self._error = e
+        finally:
+            self.session = None
+            self._ready.set()
+
+    async def started(self):
+        """Waits for the owner task to initialize the session; raises if it failed to start."""
+        await self._ready.wait()
+        if self.session is None:
+            raise RuntimeError(f"Shared MCP session failed to start: {self._error}")
+        return self.session
+
+    async def is_alive(self, timeout: float) -> bool:
+        """Pings the server; False if the owner task has ended or the server does not answer."""
+        if self.session is None or self._task.done():
+            return False
+        try:
+            await asyncio.wait_for(self.session.send_ping(), timeout)
+            return True
+        except Exception:
+            return False
+
+    async def close(self):
+        """Asks the owner task to exit the session and client, and waits for it. Safe to call twice."""
+        self._stop.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+# Shared sessions per event loop (sessions can't cross loops), each keyed by server script path
+_MCP_POOLS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple]" = weakref.WeakKeyDictionary()
+
+
+def _mcp_pool():
+    """Returns the running loop's ({server_path: _SharedMCPSession}, lock), created on first use inside the loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _MCP_POOLS:
+        _MCP_POOLS[loop] = ({}, asyncio.Lock())
+    return _MCP_POOLS[loop]
+
 
 # --- Data Structures ---
 class CMAAnalysisState(TypedDict, total=False):
     excel_file_path: str
-    insights: Dict[str, str]
+    insights: Dict[str, str] # Only insights that could not be written to insight_paths
     sheets_data: Dict[str, str]
     output_path: str # Should be Path object internally, string for state
     sheets_to_analyze: List[str]
@@ -69,6 +178,7 @@ class CMAAnalysisState(TypedDict, total=False):
     error_logs: List[str] # Add error logging to state
     timestamp: str # Add timestamp to state
     graph_inputs: Dict[str,str] # Add timestamp to state
+    insight_paths: Dict[str, str] # Sheet name -> insight file written by the analysis node (read via _load_insights)
 
 
 # --- CMAAnalyzer Class ---
@@ -96,24 +206,37 @@ class CMAAnalyzer:
         self.logger = logger
         self.account = account
         self.timestamp = datetime.now().strftime("%Y%m%d_%H%M%S") # Generate timestamp per instance
+        self._encoding = self.config.get("file_encoding", "utf-8") # Used by every file read/write
 
         # --- LLM Initialization ---
         self.model_name = str(self.config.get("model_name", "")).lower()
+        self._condense_llm = None # Optional cheaper model for condensing oversized insights
         if llm:
              self.llm = llm
         elif "gpt" in self.model_name:
             if not all([AZURE_API_KEY, AZURE_ENDPOINT, AZURE_API_VERSION]):
                  raise ValueError("Missing Azure OpenAI environment variables for GPT model.")
+            from langchain_openai import AzureChatOpenAI
             self.llm = AzureChatOpenAI(
                 model=self.config["model_name"],
                 api_key=AZURE_API_KEY,
                 azure_endpoint=AZURE_ENDPOINT,
                 api_version=AZURE_API_VERSION,
                 temperature=0,
+                stream_usage=True, # Report token usage on streamed responses too
             )
+            if self.config.get("condense_model_name"):
+                self._condense_llm = AzureChatOpenAI(
+                    model=self.config["condense_model_name"],
+                    api_key=AZURE_API_KEY,
+                    azure_endpoint=AZURE_ENDPOINT,
+                    api_version=AZURE_API_VERSION,
+                    temperature=0,
+                )
         elif "gemini" in self.model_name:
             if not GOOGLE_API_KEY:
                  raise ValueError("Missing GOOGLE_API_KEY environment variable for Gemini model.")
+            from langchain_google_genai import ChatGoogleGenerativeAI
             self.llm = ChatGoogleGenerativeAI(
                 model=self.config["model_name"],
                 google_api_key=GOOGLE_API_KEY,
@@ -123,16 +246,47 @@ class CMAAnalyzer:
             raise ValueError(f"Unsupported or missing model_name in config: {self.config.get('model_name')}")
 
         self.string_output_parser = StrOutputParser()
+        # Built once and reused for every sheet; kept as prompt | llm so token usage stays available
+        self._format_chain = ChatPromptTemplate.from_messages(
+            [("system", DATA_FORMAT_SYSTEM_PROMPT), ("human", "Data: {sheet_data}")]
+        ) | self.llm
+        self._cumulative_prompt = ChatPromptTemplate.from_messages(
+            [("system", CUMULATIVE_REPORT_SYSTEM_PROMPT),
+             ("human", "**Account:** {account}\n\n"
+                       "**Individual Section Analyses Input:**\n\n{insights_str}\n\n"
+                       "**Generate the Cumulative Report:**")]
+        )
+        # Cap the synthesis completion so an oversized prompt can't drive an unbounded response
+        cumulative_max_tokens = self.config.get("cumulative_max_tokens", 4096)
+        if "gemini" in self.model_name:
+            self._synth_llm = self.llm.bind(generation_config={"max_output_tokens": cumulative_max_tokens})
+        else:
+            self._synth_llm = self.llm.bind(max_tokens=cumulative_max_tokens)
+        self._condense_chain = ChatPromptTemplate.from_messages(
+            [("system", INSIGHT_CONDENSE_SYSTEM_PROMPT), ("human", "## Analysis for: {name}\n\n{content}")]
+        ) | (self._condense_llm or self.llm)
+        self._token_encoding = None # tiktoken encoding, loaded on first use
         # Ensure output_path is absolute and specific to this run/account
         self.output_path = Path(output_path).resolve() # Use resolve() for absolute path
+        # output_path is already unique per run, so the cumulative report keeps the name the API reads
+        self._cumulative_path = self.output_path / "Cumulative_Report.md"
         self.tools = []
+        self._insight_ok: Dict[str, bool] = {} # Sheet name -> insight usable for the cumulative report
 
         # Ensure output directory exists (safer to do it just before writing)
         self.output_path.mkdir(parents=True, exist_ok=True) # Moved lower
         self.logger.info(f"Analyzer initialized. Output base path set to: {self.output_path}")
         self.logger.info(f"Timestamp for this run: {self.timestamp}")
 
+        # Resolve the data extraction format file once; every sheet uses the same file
+        project_root = Path(__file__).resolve().parent.parent
+        self._data_format_file_path = project_root / "data" / "input_data_sources" / self.config['data_extraction_format_filename']
+        if not self._data_format_file_path.is_file():
+            self.logger.error(f"Data format file not found at expected path: {self._data_format_file_path}")
+            raise FileNotFoundError(f"Data format file not found: {self._data_format_file_path}")
+
         # --- MCP Client Setup ---
+        from mcp import StdioServerParameters
         self.server_params = StdioServerParameters(
             command=sys.executable,
             args=[self.mcp_server_path],
@@ -141,6 +295,8 @@ class CMAAnalyzer:
         self.read = None
         self.write = None
         self.mcp_session = None
+        self.reuse_mcp_session = bool(self.config.get("mcp_reuse_session", False))
+        self._pooled_mcp: Optional[_SharedMCPSession] = None # Borrowed shared session, if any
 
         self.run_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.db_conn = None
@@ -149,6 +305,10 @@ class CMAAnalyzer:
         self.db_path = db_dir / "cred360.db"
 
         self.logger.info(f"LLM Call logging configured. Database path: {self.db_path}")
+
+        # --- Compile Workflow once; per-run inputs are passed through the state ---
+        self._compiled_workflow = self._create_langgraph_workflow().compile()
+        self.logger.info("LangGraph workflow compiled.")
         self.logger.info(f"Analyzer initialized in Thread ID: {threading.get_ident()}")  # Log init thread
 
 
@@ -158,11 +318,10 @@ class CMAAnalyzer:
         try:
             await self._setup_database()
 
-            self.mcp_client = stdio_client(self.server_params)
-            self.read, self.write = await self.mcp_client.__aenter__()
-            self.mcp_session = ClientSession(self.read, self.write)
-            await self.mcp_session.__aenter__()
-            await self.mcp_session.initialize()
+            if self.reuse_mcp_session:
+                await self._acquire_pooled_mcp_session()
+            else:
+                await self._open_mcp_session()
             self.logger.info("MCP client and session initialized successfully.")
             return self
         except Exception as e:
@@ -183,6 +342,13 @@ class CMAAnalyzer:
                 self.logger.error(f"aiosqlite Error during closing connection: {e}", exc_info=True)
             finally:
                 self.db_conn = None
+
+        if self._pooled_mcp is not None:
+            # The shared session is closed by its owner task once the last analyzer releases it
+            await self._release_pooled_mcp_session()
+            self.logger.info("Async context exited (shared MCP session released).")
+            return
+
         self.logger.info("Exiting async context: Cleaning up MCP session and client...")
         # Exit session first
         try:
@@ -218,6 +384,53 @@ class CMAAnalyzer:
         self.logger.info("Async context exited.")
 
 
+    async def _open_mcp_session(self):
+        """Starts the MCP stdio client and an initialized session on this instance."""
+        from mcp import ClientSession, stdio_client
+        self.mcp_client = stdio_client(self.server_params)
+        self.read, self.write = await self.mcp_client.__aenter__()
+        self.mcp_session = ClientSession(self.read, self.write)
+        await self.mcp_session.__aenter__()
+        await self.mcp_session.initialize()
+
+    async def _acquire_pooled_mcp_session(self):
+        """Borrows the shared MCP session for this server script, (re)starting it if missing or unresponsive."""
+        pool, lock = _mcp_pool()
+        async with lock:
+            shared = pool.get(self.mcp_server_path)
+            if shared is not None and not await shared.is_alive(self.config.get("mcp_ping_timeout", 5)):
+                self.logger.warning(f"Shared MCP session for {self.mcp_server_path} is not responding; restarting it")
+                del pool[self.mcp_server_path]
+                await shared.close()
+                shared = None
+            if shared is None:
+                self.logger.info(f"Starting shared MCP session for: {self.mcp_server_path}")
+                shared = _SharedMCPSession(self.server_params)
+                try:
+                    await shared.started()
+                except Exception:
+                    await shared.close()
+                    raise
+                pool[self.mcp_server_path] = shared
+            else:
+                self.logger.info(f"Reusing shared MCP session for: {self.mcp_server_path}")
+            shared.ref_count += 1
+            self._pooled_mcp = shared
+            self.mcp_session = shared.session
+
+    async def _release_pooled_mcp_session(self):
+        """Returns the borrowed shared MCP session; the last borrower asks its owner task to close it."""
+        shared, self._pooled_mcp = self._pooled_mcp, None
+        self.mcp_session = None
+        pool, lock = _mcp_pool()
+        async with lock:
+            shared.ref_count -= 1
+            if shared.ref_count > 0:
+                return
+            if pool.get(self.mcp_server_path) is shared:
+                del pool[self.mcp_server_path]
+        await shared.close()
+
     async def initialize_agent(self):
         """Initializes the agent with tools. Requires active MCP session."""
         if not self.mcp_session:
@@ -242,7 +455,8 @@ class CMAAnalyzer:
              raise RuntimeError("MCP session not initialized. Call within 'async with' block.")
         try:
             self.logger.info("Loading tools from MCP server...")
-            self.tools = await load_mcp_tools(self.mcp_session)
+            from langchain_mcp_adapters.tools import load_mcp_tools
+            self.tools = self._partition_tools_by_concurrency(await load_mcp_tools(self.mcp_session))
             self.logger.info(f"Loaded tools: {[tool.name for tool in self.tools]}")
         except Exception as e:
             self.logger.error(f"Error getting tools from MCP server: {e}", exc_info=True)
@@ -250,6 +464,30 @@ class CMAAnalyzer:
             # Decide if this is fatal
             # raise # Option: re-raise if tools are essential
 
+    def _partition_tools_by_concurrency(self, tools: List[Any]) -> List[Any]:
+        """
+        Tags each MCP tool with 'is_concurrency_safe' in its metadata.
+        The agent's tool node gathers all tool calls of a step concurrently, so safe
+        (read-only) tools run in parallel while unsafe ones share a lock and run one at a time.
+        """
+        unsafe_lock = asyncio.Lock()
+        for tool in tools:
+            is_safe = tool.name.startswith(CONCURRENCY_SAFE_TOOL_PREFIXES)
+            tool.metadata = {**(tool.metadata or {}), "is_concurrency_safe": is_safe}
+            if not is_safe and tool.coroutine:
+                tool.coroutine = self._serialize_coroutine(tool.coroutine, unsafe_lock)
+        self.logger.info(f"Concurrency-safe tools: {[tool.name for tool in tools if tool.metadata['is_concurrency_safe']]}")
+        return tools
+
+    @staticmethod
+    def _serialize_coroutine(coroutine, lock: asyncio.Lock):
+        """Wraps a tool coroutine so that calls holding the same lock never overlap."""
+        @functools.wraps(coroutine)
+        async def serialized(*args, **kwargs):
+            async with lock:
+                return await coroutine(*args, **kwargs)
+        return serialized
+
     def _get_sub_dir(self, dir_key: str) -> Path:
         """Helper to get and create a subdirectory path."""
         sub_dir = self.output_path / self.config.get(dir_key, dir_key) # Use key as dir name if not in config
@@ -265,9 +503,14 @@ class CMAAnalyzer:
             # --- Case 1: Response has response_metadata (Common for OpenAI/Azure) ---
             if "gpt" in self.model_name.lower():
                 if hasattr(response, 'response_metadata') and response.response_metadata and isinstance(
-                        response.response_metadata, dict):
+                        response.response_metadata, dict) and 'token_usage' in response.response_metadata:
                     metadata_dict = response.response_metadata
                     self.logger.debug("Checking response.response_metadata")
+                elif hasattr(response, 'usage_metadata') and response.usage_metadata and isinstance(
+                        response.usage_metadata, dict):
+                    # Streamed responses only carry usage_metadata
+                    metadata_dict = response.usage_metadata
+                    self.logger.debug("Checking response.usage_metadata")
 
             # --- Case 2: Response has usage_metadata (Common for Gemini) ---
             elif "gemini" in self.model_name.lower() and hasattr(response, 'usage_metadata') and response.usage_metadata and isinstance(response.usage_metadata,
@@ -375,6 +618,16 @@ class CMAAnalyzer:
                         status TEXT NOT NULL CHECK(status IN ('completed', 'failed'))
                     )
                 """)
+                # Cumulative reports keyed by a digest of the synthesis prompt, reused across runs
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS cumulative_report_cache (
+                        prompt_hash TEXT PRIMARY KEY,
+                        account_name TEXT NOT NULL,
+                        model_name TEXT NOT NULL,
+                        report TEXT NOT NULL,
+                        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
             await self.db_conn.commit()
             self.logger.info(f"Async DB connection established and table checked in Thread ID: {threading.get_ident()}")
         except Exception as e: # Catch generic Exception as aiosqlite might raise different errors
@@ -423,6 +676,31 @@ class CMAAnalyzer:
             self.logger.error(f"aiosqlite Error during logging LLM call (Thread ID: {current_thread_id}): {e}",
                               exc_info=True)
 
+    async def _get_cached_cumulative_report(self, prompt_hash: str) -> Optional[str]:
+        """Returns a previously generated cumulative report for the same prompt, if any."""
+        if not self.db_conn or not self.config.get("cumulative_report_cache", True):
+            return None
+        try:
+            async with self.db_conn.execute(
+                    "SELECT report FROM cumulative_report_cache WHERE prompt_hash = ?", (prompt_hash,)) as cursor:
+                row = await cursor.fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            self.logger.error(f"aiosqlite Error reading cumulative report cache: {e}", exc_info=True)
+            return None
+
+    async def _store_cached_cumulative_report(self, prompt_hash: str, report: str):
+        """Stores a generated cumulative report under its prompt digest."""
+        if not self.db_conn or not self.config.get("cumulative_report_cache", True):
+            return
+        try:
+            await self.db_conn.execute(
+                "INSERT OR REPLACE INTO cumulative_report_cache (prompt_hash, account_name, model_name, report) "
+                "VALUES (?, ?, ?, ?)", (prompt_hash, self.account, self.model_name, report))
+            await self.db_conn.commit()
+        except Exception as e:
+            self.logger.error(f"aiosqlite Error writing cumulative report cache: {e}", exc_info=True)
+
     # --- Graph Nodes ---
 
     def extract_data_from_excel_to_markdown(self, state: CMAAnalysisState) -> Dict[str, Any]:
@@ -436,20 +714,24 @@ class CMAAnalyzer:
 
         extracted_sheets_data = {}
         try:
-            excel_file = pd.ExcelFile(excel_file_path)
-            sheet_names_to_process = excel_file.sheet_names # Process all sheets by default
+            # Open the workbook once (pandas' openpyxl reader already loads it read-only, values only)
+            # and close the handle as soon as the sheets are read
+            with pd.ExcelFile(excel_file_path, engine="openpyxl") as excel_file:
+                sheet_names_to_process = excel_file.sheet_names # Process all sheets by default
+
+                # Optional: Filter sheets based on config (if needed)
+                configured_sheets = self.config.get("sheets_to_analyze")
+                if configured_sheets:
+                    sheet_names_to_process = [s for s in sheet_names_to_process if s.lower() in configured_sheets]
+                    self.logger.info(f"Filtering sheets based on config: {sheet_names_to_process}")
 
-            # Optional: Filter sheets based on config (if needed)
-            configured_sheets = self.config.get("sheets_to_analyze")
-            if configured_sheets:
-                sheet_names_to_process = [s for s in sheet_names_to_process if s.lower() in configured_sheets]
-                self.logger.info(f"Filtering sheets based on config: {sheet_names_to_process}")
+                # Read all selected sheets in a single call (returns {sheet_name: DataFrame})
+                sheets_dict = excel_file.parse(sheet_name=sheet_names_to_process)
 
-            for sheet_name in sheet_names_to_process:
+            for sheet_name, excel_data in sheets_dict.items():
                 self.logger.debug(f"Processing sheet: {sheet_name}")
                 try:
-                    # Read, clean, and convert to markdown
-                    excel_data = pd.read_excel(excel_file, engine="openpyxl", sheet_name=sheet_name)
+                    # Clean and convert to markdown
                     cleaned_excel_data = excel_data.dropna(how="all").fillna("").reset_index(drop=True)
                     markdown_text = cleaned_excel_data.to_markdown(index=False) # Often better without index
                     text = f"##### Sheet: {sheet_name}\n\n{markdown_text}" # Clearer header
@@ -479,9 +761,8 @@ class CMAAnalyzer:
                 md_file_name = f"{safe_filename_base}_{self.timestamp}.md".lower()
                 md_file_path = extracted_md_path / md_file_name
                 try:
-                    with open(md_file_path, "w", encoding=self.config.get("file_encoding", "utf-8")) as md_file:
-                        md_file.write(content)
-                        graph_inputs[filename_base] = md_file_path
+                    md_file_path.write_text(content, encoding=self._encoding)
+                    graph_inputs[filename_base] = md_file_path
                     self.logger.info(f"Saved extracted Markdown: {md_file_path}")
                 except Exception as e:
                     self.logger.error(f"Error saving extracted Markdown '{md_file_path}': {e}")
@@ -513,16 +794,9 @@ class CMAAnalyzer:
         try:
             tokens = {"input": 0, "output": 0, "total": 0}
             status = "failed"
-            current_dir = Path(__file__).parent
-            project_root = current_dir.parent
-            data_format_file_path = project_root / "data" / "input_data_sources" / self.config['data_extraction_format_filename']
+            data_format_file_path = self._data_format_file_path
 
-            if not data_format_file_path.is_file():
-                self.logger.error(f"Data format file not found at expected path: {data_format_file_path}")
-                state.setdefault("error_logs", []).append(f"Config Error: Data format file not found for {sheet_name}")
-                return None
-
-            with open(data_format_file_path, "r", encoding=self.config.get("file_encoding", "utf-8")) as f:
+            with open(data_format_file_path, "r", encoding=self._encoding) as f:
                 data_format_config = json.load(f)
 
             data_format_template = data_format_config.get("data_format", {}).get(sheet_name)
@@ -535,48 +809,28 @@ class CMAAnalyzer:
             state.setdefault("error_logs", []).append(f"Config Error: Failed to load data format for {sheet_name}: {e}")
             return None # Cannot proceed reliably
 
+        # --- Fast path: small, clean tables are mapped onto the template without an LLM call ---
+        if len(sheet_data) < self.config.get("llm_format_skip_bytes", 2048):
+            parsed_result = self._parse_sheet_in_required_format(sheet_data, data_format_template)
+            if parsed_result:
+                self.logger.info(f"Formatted data for '{sheet_name}' parsed directly; skipping LLM call.")
+                self._save_formatted_data(state, sheet_name, parsed_result)
+                return parsed_result
+            self.logger.debug(f"Direct parsing did not match the data format for '{sheet_name}'; using LLM.")
+
         # --- Call LLM for Formatting ---
         try:
             self.logger.info(f"Invoking LLM to format data for: {sheet_name}")
-            system_prompt = dedent(
-                f"""
-                                You are an intelligent data extraction assistant. Your task is to analyze and understand the provided data, extract the data in the below format. 
-                                {{{data_format_template}}}
-
-                                Output must be in the above format only. Produce a clean output without any ```json or ```python or ```.
-                                If you are unable to find any value, put 0 respectively. Values should be Numeric. Modify the date in same format (DD-MM-YYYY).
-                                """,
-            )
-
-            prompt = ChatPromptTemplate.from_messages(
-                [("system", system_prompt), ("human", f"Data: {dedent(sheet_data)}")]
+            llm_agent = await self._format_chain.ainvoke(
+                {"data_format_template": data_format_template, "sheet_data": dedent(sheet_data)}
             )
 
-            data_extraction_chain = prompt | self.llm
-
-            llm_agent = data_extraction_chain.invoke({"data": sheet_data})
-
             tokens = self._extract_token_usage(llm_agent)
 
-            if hasattr(llm_agent, 'content'):
-                status = "completed"
-                llm_agent_result = llm_agent.content
-                extracted_metrics_path = self._get_sub_dir("extracted_metrics_dir")
-                # safe_sheet_name = re.sub(r'[^\w\-]+', '_', sheet_name)
-                safe_sheet_name = re.sub(r'[-, ]+', '_', sheet_name)
-                output_file_path = extracted_metrics_path / f"{safe_sheet_name}_{self.timestamp}.json".lower() # Save as JSON
-                try:
-                    with open(output_file_path, "w", encoding=self.config.get("file_encoding", "utf-8")) as output_file:
-                        output_file.write(llm_agent_result)
-                    self.logger.info(f"Saved formatted data extract: {output_file_path}")
-                except Exception as e:
-                    self.logger.error(f"Error saving formatted data extract '{output_file_path}': {e}")
-                    state.setdefault("error_logs", []).append(f"File Write Error (Formatted Data: {sheet_name}): {e}")
-            else:
-                llm_agent_result = str(llm_agent)
-                self.logger.warning(
-                    f"LLM result for formatting '{sheet_name}' did not have 'content' attribute. Type: {type(llm_agent_result)}")
-
+            # prompt | llm always yields an AIMessage
+            llm_agent_result = llm_agent.content
+            status = "completed"
+            self._save_formatted_data(state, sheet_name, llm_agent_result)
             return llm_agent_result
 
         except Exception as err:
@@ -594,6 +848,77 @@ class CMAAnalyzer:
                     status=status
                 )
 
+    def _parse_sheet_in_required_format(self, sheet_data: str, data_format_template: Dict[str, Any]) -> Optional[str]:
+        """
+        Deterministically maps clean markdown tables onto the data format template.
+        Each table must have a label column followed by date columns. Aggregated sheets
+        ("Balance Sheet" + "Balance Sheet2") hold one table per section; every template key
+        must have a value for every date across them, and a date reported twice must agree.
+        Returns the formatted JSON string, or None if the sheet does not fit.
+        """
+        # Split into tables: each run of consecutive pipe lines is one section's table
+        tables, block = [], []
+        for line in sheet_data.splitlines() + [""]:
+            if line.startswith("|"):
+                block.append(line)
+            elif block:
+                tables.append(block)
+                block = []
+        if not tables:
+            return None
+        try:
+            merged: Dict[str, Dict[pd.Timestamp, float]] = {}
+            all_dates: Dict[pd.Timestamp, None] = {} # Ordered set of dates in table order
+            for table_lines in tables:
+                # A table needs a header, a markdown separator row and at least one data row
+                if len(table_lines) < 3 or not set(table_lines[1]) <= set("|-: "):
+                    return None
+                # Drop the separator row and the empty edge columns around the outer pipes
+                table = pd.read_csv(StringIO("\n".join([table_lines[0]] + table_lines[2:])), sep="|",
+                                    engine="c", dtype=str, skipinitialspace=True).iloc[:, 1:-1]
+                labels = table.iloc[:, 0].str.strip().str.lower()
+                dates = pd.to_datetime(pd.Series(table.columns[1:]).str.strip(), format="mixed", dayfirst=True,
+                                       errors="raise").tolist()
+                all_dates.update(dict.fromkeys(dates))
+
+                for key in data_format_template:
+                    if key == "Date":
+                        continue
+                    row = table.loc[labels == key.lower()]
+                    if row.empty:
+                        continue
+                    # Blank cells come through as "nan" (to_markdown) or ""; treat both as missing, filled with 0
+                    values = pd.to_numeric(row.iloc[0, 1:].str.strip().replace({"nan": None, "": None}), errors="raise")
+                    key_values = merged.setdefault(key, {})
+                    for date, value in zip(dates, values.fillna(0).round(2).tolist()):
+                        if key_values.setdefault(date, value) != value:
+                            return None # Sections disagree; leave it to the LLM
+
+            formatted = {"Date": [date.strftime("%d-%m-%Y") for date in all_dates]}
+            for key in data_format_template:
+                if key == "Date":
+                    continue
+                key_values = merged.get(key, {})
+                if len(key_values) != len(all_dates):
+                    return None
+                formatted[key] = [key_values[date] for date in all_dates]
+            return json.dumps(formatted, indent=4)
+        except (ValueError, TypeError, IndexError, AttributeError, KeyError, pd.errors.ParserError):
+            return None
+
+    def _save_formatted_data(self, state: CMAAnalysisState, sheet_name: str, formatted_data: str):
+        """Saves the formatted data extract for a sheet to the extracted metrics directory."""
+        extracted_metrics_path = self._get_sub_dir("extracted_metrics_dir")
+        # safe_sheet_name = re.sub(r'[^\w\-]+', '_', sheet_name)
+        safe_sheet_name = re.sub(r'[-, ]+', '_', sheet_name)
+        output_file_path = extracted_metrics_path / f"{safe_sheet_name}_{self.timestamp}.json".lower() # Save as JSON
+        try:
+            output_file_path.write_text(formatted_data, encoding=self._encoding)
+            self.logger.info(f"Saved formatted data extract: {output_file_path}")
+        except Exception as e:
+            self.logger.error(f"Error saving formatted data extract '{output_file_path}': {e}")
+            state.setdefault("error_logs", []).append(f"File Write Error (Formatted Data: {sheet_name}): {e}")
+
     def _rename_file_for_archiving(self, file_path: Path):
         """Archives an existing file by appending its last modified time."""
         if not file_path.is_file():
@@ -633,82 +958,116 @@ class CMAAnalyzer:
             self.logger.error(f"Failed to initialize PromptGenerator: {e}", exc_info=True)
             raise
 
-        extracted_sheets_data = state.get("sheets_data", {})
         sheets_to_analyze = state.get("sheets_to_analyze", [])
         self.logger.info(f"Sheets queued for analysis: {sheets_to_analyze}")
         analysis_insights = state.get("insights", {}) # Continue from previous state if any
 
         reports_path = self._get_sub_dir("reports_dir")
         audit_data_path = self._get_sub_dir("audit_data") # For tool outputs
-        knowledge_df = pd.DataFrame()
-        for sheet_name in sheets_to_analyze:
-            self.logger.info(f"--- Analyzing Sheet: {sheet_name} ---")
-            try:
-                sheet_data = extracted_sheets_data.get(sheet_name)
-                if not sheet_data:
-                    self.logger.warning(f"No data found in state for sheet: {sheet_name}. Skipping.")
-                    analysis_insights[sheet_name] = "Error: No data found in state."
-                    state.setdefault("error_logs", []).append(f"Analysis Skip (No Data): {sheet_name}")
-                    continue
-
-                # --- Optional: Data Formatting Sub-step ---
-                formatted_data = await self.extract_data_in_required_format(state, sheet_name)
-                # Update state if formatting produced output (used by prompt generator)
-                if formatted_data:
-                    extracted_format_data = (formatted_data.replace("```json","")
-                                             .replace("```python","").replace("```",""))
-                    converted_dict = ast.literal_eval(extracted_format_data)
-                    if not isinstance(converted_dict, dict):
-                        raise TypeError("String did not evaluate to a dictionary")
-                    print(f"  Successfully converted to dict: {converted_dict}")
-
-                    temp_df = pd.DataFrame(converted_dict)
-                    if knowledge_df.empty:
-                        knowledge_df = pd.concat([knowledge_df, temp_df], ignore_index=True)
-                    else:
-                        knowledge_df = pd.merge(knowledge_df, temp_df, on='Date', how='inner')
-                    print(knowledge_df)
-                    print("  Appended to global DataFrame.")
 
-                    state["llm_agent_result"] = formatted_data # Store potentially formatted data
-                else:
-                    state["llm_agent_result"] = ""
+        # Analyze sheets concurrently, capping the number of in-flight LLM requests
+        semaphore = asyncio.Semaphore(self.config.get("max_concurrency", 8))
+
+        insights_path = self._get_sub_dir("insights_dir")
+        insight_paths: Dict[str, str] = {}
+        self._insight_ok = {}
+
+        async def analyze_with_limit(sheet_name: str) -> List[pd.DataFrame]:
+            async with semaphore:
+                frames = await self._analyze_sheet(state, sheet_name, prompt_generator, analysis_insights,
+                                                   reports_path, audit_data_path)
+            # Flush the insight to disk as soon as it is produced and keep only its path in state, so
+            # the text isn't held in memory or carried through the graph; a later crash does not lose it
+            content = analysis_insights.get(sheet_name)
+            if content is not None:
+                # Tag usable insights once so the cumulative report need not rescan every analysis
+                self._insight_ok[sheet_name] = not content.startswith(("Error:", "Skipped:"))
+                insight_file = insights_path / f"{re.sub(r'[-, ]+', '_', sheet_name).lower()}.md"
+                try:
+                    await asyncio.to_thread(insight_file.write_text, content, encoding=self._encoding)
+                    insight_paths[sheet_name] = str(insight_file)
+                    del analysis_insights[sheet_name]
+                except OSError as e:
+                    self.logger.error(f"Failed to persist insight for {sheet_name}; keeping it in state: {e}")
+            return frames
 
-                # --- Generate Prompt ---
-                prompt_messages = prompt_generator.get_sheet_specific_prompt(sheet_name, state)
+        sheet_frames = await asyncio.gather(*(analyze_with_limit(sheet_name) for sheet_name in sheets_to_analyze))
 
-                if not prompt_messages:
-                    self.logger.warning(f"No prompt generated for sheet: {sheet_name}. Skipping analysis.")
-                    analysis_insights[sheet_name] = "Skipped: No analysis prompt available."
-                    state.setdefault("error_logs", []).append(f"Analysis Skip (No Prompt): {sheet_name}")
-                    continue
+        # Merge formatted and tool-calculated data in sheet order, as the sequential loop did
+        knowledge_df = pd.DataFrame()
+        for sheet_name, frames in zip(sheets_to_analyze, sheet_frames):
+            for frame in frames:
+                try:
+                    if knowledge_df.empty:
+                        knowledge_df = pd.concat([knowledge_df, frame], ignore_index=True)
+                    else:
+                        knowledge_df = pd.merge(knowledge_df, frame, on='Date', how='inner')
+                except Exception as e:
+                    self.logger.error(f"Error merging data for sheet '{sheet_name}' into knowledge DataFrame: {e}")
+            if frames and self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"Knowledge DataFrame after {sheet_name}:\n{knowledge_df}")
+
+        # Keep insights in sheet order regardless of completion order
+        insight_paths = {name: insight_paths[name] for name in sheets_to_analyze if name in insight_paths}
+        analysis_insights.update({name: analysis_insights.pop(name) for name in sheets_to_analyze
+                                  if name in analysis_insights})
+        for name, content in analysis_insights.items():
+            self._insight_ok.setdefault(name, not content.startswith(("Error:", "Skipped:")))
+        self.logger.info("Finished analyzing all sheets.")
+        # Sheet markdown is only read by this node; drop it so it isn't carried to the final state
+        return {"insights": analysis_insights, "insight_paths": insight_paths, "sheets_data": {}}
 
-                # --- Invoke Agent ---
-                self.logger.info(f"Invoking agent for sheet: {sheet_name}")
-                agent_input = {"messages": prompt_messages}
-
-                llm_agent_result = await self.llm_agent_executor.ainvoke(agent_input)
-                self.logger.info(f"Agent invocation complete for sheet: {sheet_name}")
-                tokens = self._extract_token_usage(llm_agent_result)
-                status = 'completed'
-
-                # --- Process Agent Output ---
-                if not llm_agent_result or "messages" not in llm_agent_result:
-                    status = 'failed'
-                    await self._log_llm_call(
-                        call_purpose=f'Analyze Markdown and Generate Report for {sheet_name}',
-                        langgraph_node='analyze_markdown_and_generate_report',  # Or the calling node name if different
-                        input_tokens=tokens["input"],
-                        output_tokens=tokens["output"],
-                        total_tokens=tokens["total"],
-                        status=status
-                    )
-                    self.logger.error(f"Agent returned unexpected or empty result for {sheet_name}: {llm_agent_result}")
-                    analysis_insights[sheet_name] = f"Error: Agent returned invalid result for {sheet_name}."
-                    state.setdefault("error_logs", []).append(f"Agent Error (Invalid Result): {sheet_name}")
-                    continue
+    async def _analyze_sheet(self, state: CMAAnalysisState, sheet_name: str, prompt_generator: PromptGenerator,
+                             analysis_insights: Dict[str, str], reports_path: Path,
+                             audit_data_path: Path) -> List[pd.DataFrame]:
+        """
+        Analyzes a single sheet with the LLM agent and stores the outcome in analysis_insights.
+        Returns the DataFrames (formatted data, tool output) to merge into the knowledge DataFrame.
+        """
+        self.logger.info(f"--- Analyzing Sheet: {sheet_name} ---")
+        knowledge_frames = []
+        try:
+            sheet_data = state.get("sheets_data", {}).get(sheet_name)
+            if not sheet_data:
+                self.logger.warning(f"No data found in state for sheet: {sheet_name}. Skipping.")
+                analysis_insights[sheet_name] = "Error: No data found in state."
+                state.setdefault("error_logs", []).append(f"Analysis Skip (No Data): {sheet_name}")
+                return knowledge_frames
+
+            # --- Optional: Data Formatting Sub-step ---
+            formatted_data = await self.extract_data_in_required_format(state, sheet_name)
+            # Per-sheet view of the state for the prompt generator (sheets run concurrently)
+            sheet_state = {**state, "llm_agent_result": formatted_data or ""}
+            if formatted_data:
+                extracted_format_data = (formatted_data.replace("```json","")
+                                         .replace("```python","").replace("```",""))
+                converted_dict = ast.literal_eval(extracted_format_data)
+                if not isinstance(converted_dict, dict):
+                    raise TypeError("String did not evaluate to a dictionary")
+                self.logger.debug(f"Successfully converted formatted data to dict for {sheet_name}")
+                knowledge_frames.append(pd.DataFrame(converted_dict))
+
+            # --- Generate Prompt ---
+            prompt_messages = prompt_generator.get_sheet_specific_prompt(sheet_name, sheet_state)
+
+            if not prompt_messages:
+                self.logger.warning(f"No prompt generated for sheet: {sheet_name}. Skipping analysis.")
+                analysis_insights[sheet_name] = "Skipped: No analysis prompt available."
+                state.setdefault("error_logs", []).append(f"Analysis Skip (No Prompt): {sheet_name}")
+                return knowledge_frames
+
+            # --- Invoke Agent ---
+            self.logger.info(f"Invoking agent for sheet: {sheet_name}")
+            agent_input = {"messages": prompt_messages}
+
+            llm_agent_result = await self.llm_agent_executor.ainvoke(agent_input)
+            self.logger.info(f"Agent invocation complete for sheet: {sheet_name}")
+            tokens = self._extract_token_usage(llm_agent_result)
+            status = 'completed'
 
-                llm_response_messages = llm_agent_result["messages"]
+            # --- Process Agent Output ---
+            if not llm_agent_result or "messages" not in llm_agent_result:
+                status = 'failed'
                 await self._log_llm_call(
                     call_purpose=f'Analyze Markdown and Generate Report for {sheet_name}',
                     langgraph_node='analyze_markdown_and_generate_report',  # Or the calling node name if different
@@ -717,65 +1076,81 @@ class CMAAnalyzer:
                     total_tokens=tokens["total"],
                     status=status
                 )
-                # --- Save Tool Call Audit Data ---
-                tool_message = next((msg for msg in llm_response_messages if isinstance(msg, ToolMessage) and not str(msg.content).__contains__("Error")), None)
-                if tool_message:
-                    # safe_sheet_name = re.sub(r'[^\w\-]+', '_', sheet_name)
-                    safe_sheet_name = re.sub(r'[-, ]+', '_', sheet_name)
-                    audit_path = audit_data_path / f"{safe_sheet_name}_{self.timestamp}.md".lower()
-                    try:
-                        # audit_data = pd.DataFrame(ast.literal_eval(tool_message.content))
-                        audit_data = pd.DataFrame(json.loads(tool_message.content))
-                        # knowledge_df = pd.concat([knowledge_df, audit_data], ignore_index=True)
-                        knowledge_df = pd.merge(knowledge_df, audit_data, on='Date', how='inner')
-
-                        with open(audit_path, "w", encoding=self.config.get("file_encoding", "utf-8")) as f:
-                            f.write(audit_data.to_string())
-                        f.close()
-                    except Exception as e:
-                        self.logger.error(f"Error writing tool data: {e}")
-                        raise
+                self.logger.error(f"Agent returned unexpected or empty result for {sheet_name}: {llm_agent_result}")
+                analysis_insights[sheet_name] = f"Error: Agent returned invalid result for {sheet_name}."
+                state.setdefault("error_logs", []).append(f"Agent Error (Invalid Result): {sheet_name}")
+                return knowledge_frames
 
-                # --- Extract Final Report Content ---
-                # Find the last AIMessage which usually contains the final answer
-                final_ai_message = next((msg for msg in reversed(llm_response_messages) if isinstance(msg, AIMessage)), None)
+            llm_response_messages = llm_agent_result["messages"]
+            await self._log_llm_call(
+                call_purpose=f'Analyze Markdown and Generate Report for {sheet_name}',
+                langgraph_node='analyze_markdown_and_generate_report',  # Or the calling node name if different
+                input_tokens=tokens["input"],
+                output_tokens=tokens["output"],
+                total_tokens=tokens["total"],
+                status=status
+            )
+            # Single pass over the trace: first successful tool output, last AI message
+            tool_message = None
+            final_ai_message = None
+            for msg in llm_response_messages:
+                if isinstance(msg, ToolMessage):
+                    content = msg.content if isinstance(msg.content, str) else str(msg.content)
+                    if tool_message is None and "Error" not in content:
+                        tool_message = msg
+                elif isinstance(msg, AIMessage):
+                    final_ai_message = msg  # Last one wins
+
+            # --- Save Tool Call Audit Data ---
+            if tool_message:
+                # safe_sheet_name = re.sub(r'[^\w\-]+', '_', sheet_name)
+                safe_sheet_name = re.sub(r'[-, ]+', '_', sheet_name)
+                audit_path = audit_data_path / f"{safe_sheet_name}_{self.timestamp}.md".lower()
+                try:
+                    # audit_data = pd.DataFrame(ast.literal_eval(tool_message.content))
+                    audit_data = pd.DataFrame(json.loads(tool_message.content))
+                    knowledge_frames.append(audit_data)
 
-                if final_ai_message and hasattr(final_ai_message, 'content'):
-                    final_content = final_ai_message.content
-                    self.logger.info(f"Extracted final AI response for {sheet_name}.")
+                    audit_path.write_text(audit_data.to_string(), encoding=self._encoding)
+                except Exception as e:
+                    self.logger.error(f"Error writing tool data: {e}")
+                    raise
 
-                    # --- Save Individual Report ---
-                    # safe_sheet_name = re.sub(r'[^\w\-]+', '_', sheet_name)
-                    safe_sheet_name = re.sub(r'[-, ]+', '_', sheet_name)
-                    # Use timestamp in the main report name for uniqueness per run
-                    output_file_name = f"{safe_sheet_name}.md".lower()
-                    output_file_path = reports_path / output_file_name
+            # --- Extract Final Report Content ---
+            # The last AIMessage usually contains the final answer
+            if final_ai_message:
+                final_content = final_ai_message.content
+                self.logger.info(f"Extracted final AI response for {sheet_name}.")
 
-                    # Archive previous versions if any (less likely with timestamp in name)
-                    self._rename_file_for_archiving(output_file_path) # Probably not needed now
+                # --- Save Individual Report ---
+                # safe_sheet_name = re.sub(r'[^\w\-]+', '_', sheet_name)
+                safe_sheet_name = re.sub(r'[-, ]+', '_', sheet_name)
+                # Use timestamp in the main report name for uniqueness per run
+                output_file_name = f"{safe_sheet_name}.md".lower()
+                output_file_path = reports_path / output_file_name
 
-                    try:
-                        with open(output_file_path, "w", encoding=self.config.get("file_encoding", "utf-8")) as output_file:
-                            output_file.write(final_content)
-                        self.logger.info(f"Analysis report for {sheet_name} saved to {output_file_path}")
-                        analysis_insights[sheet_name] = final_content # Store successful analysis
-                    except Exception as e:
-                        self.logger.error(f"Error writing analysis report to {output_file_path}: {e}")
-                        analysis_insights[sheet_name] = f"Error: Failed to save report for {sheet_name}."
-                        state.setdefault("error_logs", []).append(f"File Write Error (Report: {sheet_name}): {e}")
+                # Archive previous versions if any (less likely with timestamp in name)
+                self._rename_file_for_archiving(output_file_path) # Probably not needed now
 
-                else:
-                    self.logger.warning(f"Could not find final AI message content for sheet: {sheet_name}")
-                    analysis_insights[sheet_name] = f"Error: No final AI response found for {sheet_name}."
-                    state.setdefault("error_logs", []).append(f"Agent Error (No Final Msg): {sheet_name}")
+                try:
+                    output_file_path.write_text(final_content, encoding=self._encoding)
+                    self.logger.info(f"Analysis report for {sheet_name} saved to {output_file_path}")
+                    analysis_insights[sheet_name] = final_content # Store successful analysis
+                except Exception as e:
+                    self.logger.error(f"Error writing analysis report to {output_file_path}: {e}")
+                    analysis_insights[sheet_name] = f"Error: Failed to save report for {sheet_name}."
+                    state.setdefault("error_logs", []).append(f"File Write Error (Report: {sheet_name}): {e}")
 
-            except Exception as e:
-                self.logger.error(f"Critical error during analysis of sheet '{sheet_name}': {e}", exc_info=True)
-                analysis_insights[sheet_name] = f"Error: Analysis failed critically for {sheet_name}."
-                state.setdefault("error_logs", []).append(f"Analysis Error (Sheet: {sheet_name}): {e}")
-                continue # Continue to the next sheet
-        self.logger.info("Finished analyzing all sheets.")
-        return {"insights": analysis_insights}
+            else:
+                self.logger.warning(f"Could not find final AI message content for sheet: {sheet_name}")
+                analysis_insights[sheet_name] = f"Error: No final AI response found for {sheet_name}."
+                state.setdefault("error_logs", []).append(f"Agent Error (No Final Msg): {sheet_name}")
+
+        except Exception as e:
+            self.logger.error(f"Critical error during analysis of sheet '{sheet_name}': {e}", exc_info=True)
+            analysis_insights[sheet_name] = f"Error: Analysis failed critically for {sheet_name}."
+            state.setdefault("error_logs", []).append(f"Analysis Error (Sheet: {sheet_name}): {e}")
+        return knowledge_frames
 
     async def graph_data_agent(self,state: CMAAnalysisState):
         graph_input = state.get("graph_inputs", {})
@@ -787,7 +1162,7 @@ class CMAAnalyzer:
                 try:
                     if not os.path.exists(file_path):
                         print(f"Warning: {file_path} not found.")
-                    with open(file_path, "r") as f:
+                    with open(file_path, "r", encoding=self._encoding) as f:
                         data = f.read()
                 except FileNotFoundError:
                     error = f"File not found: {file_path}. Please ensure the .md file is available."
@@ -816,16 +1191,15 @@ class CMAAnalyzer:
                         generated_code_agent = await graph_generation_chain.ainvoke({"data": data,"output_path":str(self.output_path).replace("\\","/"),
                                                                                      "sheet_directory":safe_sheet_name})
                         tokens = self._extract_token_usage(generated_code_agent)
-                        if hasattr(generated_code_agent,'content'):
-                            status = 'completed'
-                            generated_code = generated_code_agent.content
-                            # state["result"] = generated_code  # Store the generated code
-                            print("--- Generated Python Code ---")
-                            print(generated_code)
-                            print("-----------------------------")
+                        status = 'completed'
+                        generated_code = generated_code_agent.content
+                        # state["result"] = generated_code  # Store the generated code
+                        print("--- Generated Python Code ---")
+                        print(generated_code)
+                        print("-----------------------------")
                     except Exception as e:
                         print(f"Error invoking LLM chain: {e}")
-                        return state
+                        return {}
 
                     if "generated_code" in locals() and generated_code:
                         print("--- Executing Code with PythonREPLTool ---")
@@ -864,68 +1238,92 @@ class CMAAnalyzer:
                             total_tokens=tokens["total"],
                             status=status
                         )
+        # Graphs are written to disk; no state keys are updated
+        return {}
 
     async def generate_cumulative_report(self, state: CMAAnalysisState) -> Dict[str, Any]:
         """Node: Generates the final cumulative report from individual insights."""
         self.logger.info("Node: Generating Cumulative Report...")
-        insights = state.get("insights", {})
+        insights = await self._load_insights(state)
         if not insights:
             self.logger.warning("No analysis insights found to generate cumulative report.")
             return {"final_report": "No analysis insights were generated to create a cumulative report."}
 
-        # Format insights for the prompt
-        insights_str = "\n\n".join(
-            f"## Analysis for: {name}\n\n{content}"
-            for name, content in insights.items()
-            if "Error:" not in content and "Skipped:" not in content # Exclude errors from summary
-        )
+        # Exclude errors from summary
+        usable_insights = {name: content for name, content in insights.items()
+                           if self._insight_ok.get(name, not content.startswith(("Error:", "Skipped:")))}
+        insights_str = self._format_insights(usable_insights)
 
         if not insights_str:
              self.logger.warning("All sheet analyses resulted in errors or were skipped. No cumulative report generated.")
              return {"final_report": "Cumulative report could not be generated as all sheet analyses failed or were skipped."}
 
-        tokens = {"input": 0, "output": 0, "total": 0}
-        status = "failed"
+        # A single section has nothing to synthesize; wrap it instead of calling the LLM
+        if len(usable_insights) == 1:
+            self.logger.info("Only one sheet analysis available; skipping LLM synthesis for cumulative report.")
+            final_report_content = f"# CMA Analysis for {self.account}\n\n{insights_str}"
+            try:
+                await self._save_cumulative_report(final_report_content)
+            except Exception as err:
+                self.logger.error(f"Failed to save cumulative report: {err}", exc_info=True)
+                state.setdefault("error_logs", []).append(f"Cumulative Report Error: {err}")
+            return {"final_report": final_report_content}
 
         # --- LLM Call for Synthesis ---
-        prompt_content = f"""You are a financial analyst assistant. You have received individual analysis reports for different sections (sheets) of a financial dataset (like a CMA report). Your task is to synthesize these reports into a single, cohesive cumulative report.
-            Structure the report logically:
-            1.  **Introduction:** Briefly state the purpose (e.g., summary of CMA analysis for {self.account}) and list the sections analyzed.
-            2.  **Section Summaries:** For each analyzed section (sheet name), provide a concise summary of its key findings based on the input provided below. Use the sheet names as headings (e.g., `## Balance Sheet`).
-            3.  **Overall Conclusion/Key Takeaways:** Provide a high-level summary synthesizing the findings across all sections. Highlight any major trends, risks, or important points derived from the combined analysis.
-            
-            Ensure the output is clean Markdown.
-            
-            **Individual Section Analyses Input:**
-            
-            {insights_str}
-            
-            **Generate the Cumulative Report:**
-            
-            Final output should be without ```markdown and ```.
-            """
-        messages = [HumanMessage(content=prompt_content)]
+        messages = self._cumulative_prompt.format_messages(account=self.account, insights_str=insights_str)
+
+        # Identical prompts (e.g. a rerun on the same Excel) reuse the stored report. The completion cap and
+        # condense settings are part of the key, so a report produced under other limits isn't served.
+        settings = [self.model_name, str(self.config.get("cumulative_max_tokens", 4096)),
+                    str(self.config.get("condense_model_name")), str(self.config.get("insight_condense_tokens", 800))]
+        prompt_hash = hashlib.sha256(
+            "\n".join(settings + [message.content for message in messages]).encode("utf-8")
+        ).hexdigest()
+        cached_report = await self._get_cached_cumulative_report(prompt_hash)
+        if cached_report is not None:
+            self.logger.info("Cumulative report found in cache; skipping LLM call.")
+            try:
+                await self._save_cumulative_report(cached_report)
+            except Exception as err:
+                self.logger.error(f"Failed to save cached cumulative report: {err}", exc_info=True)
+                state.setdefault("error_logs", []).append(f"Cumulative Report Error: {err}")
+            return {"final_report": cached_report}
+
+        tokens = {"input": 0, "output": 0, "total": 0}
+        status = "failed"
+        # Streamed into a sibling file and renamed on success, so a failed stream never leaves a
+        # truncated Cumulative_Report.md for the reports API to serve
+        partial_path = self._cumulative_path.with_name(self._cumulative_path.name + ".partial")
 
         try:
+            # Map step: condense oversized section analyses concurrently before synthesis
+            target_tokens = self.config.get("insight_condense_tokens", 800)
+            if target_tokens:
+                condensed = await asyncio.gather(*(self._condense_insight(name, content, target_tokens)
+                                                   for name, content in usable_insights.items()))
+                messages = self._cumulative_prompt.format_messages(
+                    account=self.account,
+                    insights_str=self._format_insights(dict(zip(usable_insights, condensed)))
+                )
+
             self.logger.info("Invoking LLM to generate cumulative report...")
-            response = await self.llm.ainvoke(messages)
+            # Stream the report to disk as it is generated
+            cumulative_path = self._cumulative_path
+            response = None
+            report_parts = []
+            async with aiofiles.open(partial_path, "w", encoding=self._encoding) as f:
+                async for chunk in self._synth_llm.astream(messages):
+                    response = chunk if response is None else response + chunk # Aggregate for token usage
+                    if chunk.content:
+                        report_parts.append(chunk.content)
+                        await f.write(chunk.content)
+            os.replace(partial_path, cumulative_path)
             tokens = self._extract_token_usage(response)
-            final_report_content = response.content if hasattr(response, 'content') else str(response)
-            self.logger.info("Cumulative report content generated by LLM.")
+            final_report_content = "".join(report_parts)
+            self.logger.info(f"Cumulative report generated by LLM and saved to: {cumulative_path}")
             status = 'completed'
-
-            # --- Save Cumulative Report ---
-            # Use timestamp for uniqueness per run
-            cumulative_filename = f"Cumulative_Report.md"
-            cumulative_path = self.output_path / cumulative_filename # Place it in the base output dir
-
-            # Archive previous cumulative reports for the same account (optional)
-            # You might want a different archiving strategy here, e.g., keeping only the last N
-            self._rename_file_for_archiving(cumulative_path) # Less useful with timestamp in name
-
-            with open(cumulative_path, "w", encoding=self.config.get("file_encoding", "utf-8")) as f:
-                f.write(final_report_content)
-            self.logger.info(f"Cumulative report saved to: {cumulative_path}")
+            await self._compress_cumulative_report(final_report_content)
+            await self._store_cached_cumulative_report(prompt_hash, final_report_content)
 
             return {"final_report": final_report_content}
 
@@ -936,6 +1334,7 @@ class CMAAnalyzer:
             return {"final_report": f"Error: Failed to generate cumulative report due to: {err}"}
 
         finally:
+            partial_path.unlink(missing_ok=True) # Left behind only when streaming failed
             if "tokens" in locals():
                 await self._log_llm_call(
                     call_purpose='Generating Cumulative Report',
@@ -946,6 +1345,93 @@ class CMAAnalyzer:
                     status=status
                 )
 
+    async def _load_insights(self, state: CMAAnalysisState) -> Dict[str, str]:
+        """
+        Returns every sheet insight: those persisted by the analysis node are read back from
+        insight_paths, plus any that could not be written and were kept in state["insights"].
+        """
+        insights = dict(state.get("insights", {}))
+        for name, path in state.get("insight_paths", {}).items():
+            try:
+                insights[name] = await asyncio.to_thread(Path(path).read_text, encoding=self._encoding)
+            except OSError as e:
+                self.logger.error(f"Failed to read persisted insight for {name}: {e}")
+                state.setdefault("error_logs", []).append(f"Insight Read Error ({name}): {e}")
+        return insights
+
+    @staticmethod
+    def _format_insights(insights: Dict[str, str]) -> str:
+        """Joins section analyses into the markdown block used in the cumulative prompt."""
+        buffer = StringIO()
+        for name, content in insights.items():
+            buffer.write(f"## Analysis for: {name}\n\n{content}\n\n")
+        return buffer.getvalue().rstrip()
+
+    def _count_tokens(self, text: str) -> int:
+        """Counts tokens with tiktoken, falling back to a generic encoding for non-OpenAI models."""
+        if self._token_encoding is None:
+            import tiktoken
+            try:
+                self._token_encoding = tiktoken.encoding_for_model(self.config.get("model_name", ""))
+            except KeyError:
+                self._token_encoding = tiktoken.get_encoding("o200k_base")
+        return len(self._token_encoding.encode(text))
+
+    async def _condense_insight(self, name: str, content: str, target_tokens: int) -> str:
+        """Summarizes an insight longer than target_tokens; returns it unchanged otherwise or on failure."""
+        if self._count_tokens(content) <= target_tokens:
+            return content
+
+        tokens = {"input": 0, "output": 0, "total": 0}
+        status = "failed"
+        try:
+            self.logger.info(f"Condensing analysis for {name} to about {target_tokens} tokens...")
+            response = await self._condense_chain.ainvoke(
+                {"name": name, "content": content, "target_tokens": target_tokens}
+            )
+            tokens = self._extract_token_usage(response)
+            status = 'completed'
+            return response.content
+        except Exception as err:
+            self.logger.warning(f"Failed to condense analysis for {name}, using it in full: {err}")
+            return content
+        finally:
+            await self._log_llm_call(
+                call_purpose=f'Condensing Insight: {name}',
+                langgraph_node='generate_cumulative_report',
+                input_tokens=tokens["input"],
+                output_tokens=tokens["output"],
+                total_tokens=tokens["total"],
+                status=status
+            )
+
+    async def _save_cumulative_report(self, final_report_content: str):
+        """Writes a complete cumulative report to the base output directory without blocking the event loop."""
+        cumulative_path = self._cumulative_path
+        async with aiofiles.open(cumulative_path, "w", encoding=self._encoding) as f:
+            await f.write(final_report_content)
+        self.logger.info(f"Cumulative report saved to: {cumulative_path}")
+        await self._compress_cumulative_report(final_report_content)
+
+    async def _compress_cumulative_report(self, final_report_content: str):
+        """
+        Writes a gzipped copy of the cumulative report when "compress_cumulative_report" is enabled.
+        The plain markdown is removed unless "keep_uncompressed_cumulative_report" is set (e.g. in dev).
+        """
+        if not self.config.get("compress_cumulative_report", False):
+            return
+
+        def write_gzipped(gz_path: Path):
+            # Level 1 compresses markdown well at close to copy speed
+            with gzip.open(gz_path, "wt", encoding=self._encoding, compresslevel=1) as f:
+                f.write(final_report_content)
+            if not self.config.get("keep_uncompressed_cumulative_report", False):
+                self._cumulative_path.unlink(missing_ok=True)
+
+        gz_path = self._cumulative_path.with_suffix(".md.gz")
+        await asyncio.to_thread(write_gzipped, gz_path)
+        self.logger.info(f"Compressed cumulative report saved to: {gz_path}")
+
     async def generate_customer_alert(self, state: CMAAnalysisState):
         customer_alert_output_path = Path(state["output_path"]) / "customer_alerts"
         customer_alert_output_path.mkdir(parents=True, exist_ok=True)
@@ -999,17 +1485,15 @@ class CMAAnalyzer:
         excel_file_path_obj = Path(excel_file_path)
         self.logger.info(f"Starting CMA analysis workflow for file: {excel_file_path_obj}")
 
-        if not self.mcp_session or not self.mcp_client:
+        # A borrowed shared session has no client on this instance, so only the session is required
+        if not self.mcp_session:
              raise RuntimeError("MCP Client/Session not active. Ensure run_analysis is called within 'async with CMAAnalyzer(...):'")
 
         try:
             # --- Initialize Agent (requires active MCP session) ---
             await self.initialize_agent()
 
-            # --- Compile Workflow ---
-            analysis_workflow_graph = self._create_langgraph_workflow()
-            compiled_workflow = analysis_workflow_graph.compile()
-            self.logger.info("LangGraph workflow compiled.")
+            compiled_workflow = self._compiled_workflow
 
             # --- Prepare Initial State ---
             initial_state: CMAAnalysisState = {
@@ -1056,6 +1540,21 @@ class CMAAnalyzer:
             self.logger.info("CMA Analysis run_analysis method finished.")
 
 # --- Standalone Execution Logic (Keep for testing) ---
+# Account of the standalone run executing in the current task; run_many tasks each get their own copy
+_STANDALONE_ACCOUNT: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("standalone_account", default=None)
+
+
+class _AccountLogFilter(logging.Filter):
+    """Passes only records emitted while the given account's standalone run is active."""
+
+    def __init__(self, account_name: str):
+        super().__init__()
+        self.account_name = account_name
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return _STANDALONE_ACCOUNT.get() == self.account_name
+
+
 async def run_standalone_analysis(account_name):
     """Runs the analysis as a standalone script."""
     print(f"Running standalone analysis for account: {account_name}")
@@ -1069,6 +1568,7 @@ async def run_standalone_analysis(account_name):
         "extracted_metrics_dir": "extracted_metrics",
         "reports_dir": "reports",
         "audit_data": "audit_data",
+        "insights_dir": "insights",
         "sheets_to_analyze": ["profit & loss statement","balance sheet","balance sheet2","fund flow","fund flow2"],
         "file_encoding": "utf-8",
     }
@@ -1088,19 +1588,27 @@ async def run_standalone_analysis(account_name):
     LOG_FILE = LOG_DIR / f"{account_name}_cma_analysis_standalone_{TIMESTAMP}.log"
 
     # --- Logging ---
-    logging.basicConfig(
-        level=CONFIG["log_level"],
-        format="%(asctime)s - %(levelname)s - [%(name)s] - %(message)s",
-        filename=LOG_FILE,
-        filemode='w' # Overwrite log file for each standalone run
-    )
-    # Add console handler for standalone runs
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(CONFIG["log_level"])
-    console_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    logging.getLogger('').addHandler(console_handler)
-
-    logger = logging.getLogger("StandaloneCMA")
+    # Dedicated app logger that doesn't propagate; the root logger is left untouched so library
+    # log levels and handlers in the host process don't change. Each account logs through a child
+    # logger, and its file handler sits on the app logger filtered on the account running in the
+    # current task, so concurrent run_many accounts don't write into each other's files.
+    account_token = _STANDALONE_ACCOUNT.set(account_name)
+    app_logger = logging.getLogger("StandaloneCMA")
+    app_logger.setLevel(CONFIG["log_level"])
+    app_logger.propagate = False
+    logger = app_logger.getChild(account_name)
+
+    file_handler = logging.FileHandler(LOG_FILE, mode='w', encoding=CONFIG["file_encoding"]) # Overwrite log file for each standalone run
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - [%(name)s] - %(message)s"))
+    file_handler.addFilter(_AccountLogFilter(account_name))
+    app_logger.addHandler(file_handler)
+    # Add console handler for standalone runs (once, so repeated runs don't duplicate console output)
+    if not any(getattr(handler, "standalone_console", False) for handler in app_logger.handlers):
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        console_handler.standalone_console = True
+        app_logger.addHandler(console_handler)
+
     logger.info("--- Starting Standalone CMA Analysis ---")
 
     # --- File Paths ---
@@ -1114,16 +1622,17 @@ async def run_standalone_analysis(account_name):
     logger.info(f"MCP Server Script: {mcp_server_path}")
     logger.info(f"Log File: {LOG_FILE}")
 
-    if not excel_file_path.is_file():
-        logger.error(f"Input Excel file not found: {excel_file_path}")
-        return
+    try:
+        # Early returns still go through the finally below, which detaches the file handler
+        if not excel_file_path.is_file():
+            logger.error(f"Input Excel file not found: {excel_file_path}")
+            return
 
-    if not Path(mcp_server_path).is_file():
-        logger.error(f"MCP Server script not found: {mcp_server_path}")
-        return
+        if not Path(mcp_server_path).is_file():
+            logger.error(f"MCP Server script not found: {mcp_server_path}")
+            return
 
-    # --- Instantiate and Run ---
-    try:
+        # --- Instantiate and Run ---
         # Use 'async with' to manage the analyzer's context (MCP client)
         async with CMAAnalyzer(output_path=str(output_path), account=account_name, config=CONFIG, mcp_server_path=mcp_server_path, logger=logger) as analyzer:
             final_state = await analyzer.run_analysis(str(excel_file_path))
@@ -1137,10 +1646,32 @@ async def run_standalone_analysis(account_name):
         logger.error(f"Standalone analysis failed: {e}", exc_info=True)
     finally:
         logger.info("--- Standalone CMA Analysis Finished ---")
+        app_logger.removeHandler(file_handler)
+        file_handler.close()
+        _STANDALONE_ACCOUNT.reset(account_token)
+
+
+async def run_many(accounts: List[str], max_concurrent_accounts: int = 3):
+    """
+    Runs standalone analyses for several accounts concurrently.
+    Each account gets its own analyzer, output path and MCP server process;
+    the semaphore caps concurrent runs to stay within provider rate limits.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent_accounts)
+
+    async def run_with_limit(account_name: str):
+        async with semaphore:
+            await run_standalone_analysis(account_name)
+
+    async with asyncio.TaskGroup() as tg:
+        for account_name in accounts:
+            tg.create_task(run_with_limit(account_name))
 
 
 # if __name__ == "__main__":
 #     # Example for standalone testing
 #     account = "siemens_energy" # Replace with your test account
 #     # Use asyncio.run() only here at the top level for the standalone script
-#     asyncio.run(run_standalone_analysis(account))
\ No newline at end of file
+#     asyncio.run(run_standalone_analysis(account))
+#     # Or analyze several accounts concurrently
+#     # asyncio.run(run_many(["siemens_energy", "another_account"]))
\ No newline at end of file
@@ -32,7 +32,15 @@ API_CONFIG = {
         "graph_dir": "graphs",
         "graph_data_dir": "graph_data",
         "customer_alert_dir": "customer_alerts",
+        "insights_dir": "insights",
         "file_encoding": "utf-8",
+        "compress_cumulative_report": False, # Write Cumulative_Report.md.gz instead of plain markdown
+        "keep_uncompressed_cumulative_report": False, # Also keep the plain markdown when compressing (dev)
+        "mcp_reuse_session": False, # Share one MCP server process across analyzer instances
+        "mcp_ping_timeout": 5, # Seconds to wait for a shared MCP session to answer a ping before restarting it
+        "cumulative_max_tokens": 4096, # Completion cap for the cumulative report
+        "insight_condense_tokens": 800, # Condense longer sheet analyses before the cumulative report (0 disables)
+        "condense_model_name": os.getenv("CONDENSE_MODEL"), # Cheaper Azure deployment for condensing, e.g. gpt-4o-mini
         "sheets_to_analyze": ["profit & loss statement", "balance sheet", "balance sheet2",
                               "fund flow", "fund flow2"]
         # "sheets_to_analyze":["fund flow", "fund flow2"]
@@ -9,6 +9,7 @@ import uvicorn
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 
 
 # --- Early Platform Setup ---
@@ -64,6 +65,8 @@ api.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Report responses carry HTML and base64 charts, which compress several-fold
+api.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
 
 
 # --- Include Routers ---
@@ -2,7 +2,7 @@ import logging
 import asyncio
 import sys
 import os
-import shutil
+import aiofiles
 from datetime import datetime
 from pathlib import Path
 from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends
@@ -20,9 +20,19 @@ logger = logging.getLogger(__name__)
 # Get the specific logger instance intended for the analysis task
 app_task_logger = logging.getLogger(APP_TASK_LOGGER_NAME)
 
+# Uploads are written to disk in 1 MiB reads instead of shutil's 16 KiB default
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+# Set once the subprocess test has passed, so later requests skip the fork+exec
+_subprocess_test_passed = False
+
 
 async def run_subprocess_test():
-    """Runs a simple subprocess test to check asyncio compatibility."""
+    """Runs a simple subprocess test to check asyncio compatibility, once per process after it succeeds."""
+    global _subprocess_test_passed
+    if _subprocess_test_passed:
+        return True
     logger.info("--- Attempting simplified subprocess test ---")
     try:
         command = sys.executable
@@ -43,6 +53,7 @@ async def run_subprocess_test():
 
         if exit_code == 0:
             logger.info("--- Simplified subprocess test successful ---")
+            _subprocess_test_passed = True
             return True
         else:
             logger.error(f"--- Simplified subprocess test failed (exit code: {exit_code}) ---")
@@ -154,8 +165,9 @@ async def trigger_analysis(
     try:
         # Save the uploaded file
         logger.info(f"Saving uploaded file to: {file_path} for account: {safe_account}")
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        async with aiofiles.open(file_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
         logger.info(f"File successfully saved: {file_path}")
         # --- Trigger the async analysis task ---
         logger.info(f"Triggering analysis task for account: {safe_account}, file: {file_path}")
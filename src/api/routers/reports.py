@@ -1,3 +1,4 @@
+import gzip
 import json
 import logging
 import base64
@@ -120,11 +121,15 @@ def get_analysis_reports(account_name: str) -> List[Dict[str, Any]]:
 
     # --- Get Cumulative Report from the latest run's reports directory ---
     cumulative_path = latest_run_dir / cumulative_report_filename
+    # Runs with "compress_cumulative_report" enabled only leave the gzipped report
+    if not cumulative_path.is_file() and cumulative_path.with_suffix(".md.gz").is_file():
+        cumulative_path = cumulative_path.with_suffix(".md.gz")
     logger.info(f"Checking for cumulative report in latest run: {cumulative_path}")
 
     if cumulative_path.is_file():
         try:
-            with open(cumulative_path, 'r', encoding=file_encoding) as file:
+            opener = gzip.open if cumulative_path.suffix == ".gz" else open
+            with opener(cumulative_path, 'rt', encoding=file_encoding) as file:
                 content_md = file.read()
                 content_html = markdown2.markdown(content_md, extras=["tables", "fenced-code-blocks", "code-friendly"])
                 report_files_content.append({
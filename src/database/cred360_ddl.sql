@@ -61,3 +61,15 @@ CREATE TABLE audit_llm_calls (
     total_tokens INTEGER NOT NULL,          -- Total number of tokens (input + output)
     status TEXT NOT NULL CHECK(status IN ('completed', 'failed'))  -- Status of the call (completed or failed)
 );
+
+-- Drop tables if `cumulative_report_cache` exist
+DROP TABLE IF EXISTS cumulative_report_cache;
+
+-- Create `cumulative_report_cache` table
+CREATE TABLE cumulative_report_cache (
+    prompt_hash TEXT PRIMARY KEY,           -- SHA-256 of the model name and synthesis prompt
+    account_name TEXT NOT NULL,             -- Name of the account the report was generated for
+    model_name TEXT NOT NULL,               -- Name of the language model used
+    report TEXT NOT NULL,                   -- Generated cumulative report (Markdown)
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP  -- Timestamp when the report was cached
+);
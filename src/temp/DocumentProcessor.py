@@ -1,8 +1,22 @@
+import asyncio
+import hashlib
+import io
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import re
 import shutil
+import struct
+import sys
 import tempfile
+import threading
 import uuid
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, Union
 
@@ -14,23 +28,193 @@ import mammoth  # For DOCX conversion
 import markdown
 
 # Document processing libraries
+import numpy as np
+import orjson
 import pandas as pd
 import psycopg2
 import PyPDF2
 import pytesseract
+import torch
+from cachetools import LRUCache
 from colpali import (
     Colpali,  # Note: Colpali is hypothetical, might need to be replaced with actual implementation
 )
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import Chroma
+from pdf2image import convert_from_path
 from PIL import Image
-from psycopg2.extras import Json
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Splits markdown at each major section header ("# ") without consuming it
+_SECTION_RE = re.compile(r'(?m)^(?=# )')
+
+# EasyOCR reader of an OCR worker process, created on its first page
+_worker_ocr_reader = None
+
+
+def _ocr_one_page(image: np.ndarray) -> str:
+    """OCR a single page image inside a worker process, falling back to Tesseract."""
+    global _worker_ocr_reader
+    try:
+        if _worker_ocr_reader is None:
+            _worker_ocr_reader = easyocr.Reader(['en'])
+        result = _worker_ocr_reader.readtext(image)
+        page_text = "\n\n".join(text for _, text, _ in result)
+        if page_text.strip():
+            return page_text
+    except Exception as e:
+        logger.warning(f"EasyOCR failed: {str(e)}")
+    return pytesseract.image_to_string(Image.fromarray(image))
+
+
+# Largest number of records Chroma's SQLite backend accepts in a single add call
+CHROMA_MAX_BATCH_SIZE = 5461
+
+# Read statements prepared once per pooled PostgreSQL connection and run with EXECUTE afterwards
+_PG_PREPARED_STATEMENTS = {
+    # $1 account name, $2 datasource name, $3 chunk ID
+    "get_related_chunks": """
+        PREPARE get_related_chunks(text, text, text) AS
+        WITH target AS (
+            SELECT dc.datasource_id, dc.parent_chunk_id
+            FROM document_chunks dc
+            JOIN datasources ds ON dc.datasource_id = ds.id
+            JOIN accounts acc ON ds.account_id = acc.id
+            WHERE acc.name = $1 AND ds.name = $2 AND dc.chunk_id = $3
+        )
+        SELECT 'parent' AS relation, c.chunk_id, c.document_id, c.parent_chunk_id, c.content, c.metadata
+        FROM document_chunks c
+        JOIN target t ON c.datasource_id = t.datasource_id AND c.chunk_id = t.parent_chunk_id
+        UNION ALL
+        SELECT 'child', c.chunk_id, c.document_id, c.parent_chunk_id, c.content, c.metadata
+        FROM document_chunks c
+        JOIN target t ON c.datasource_id = t.datasource_id AND c.parent_chunk_id = $3
+        ORDER BY relation DESC
+    """,
+}
+
+# Documents with at least this many chunks are loaded with binary COPY instead of multi-row INSERTs
+COPY_MIN_CHUNKS = 1000
+
+# Signature, flags and header extension length that open every binary COPY stream
+_PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_PGCOPY_NULL = struct.pack('>i', -1)
+
+
+def _pgcopy_text(value: Optional[str]) -> bytes:
+    """Encode a text field for binary COPY."""
+    if value is None:
+        return _PGCOPY_NULL
+    data = value.encode('utf-8')
+    return struct.pack('>i', len(data)) + data
+
+
+def _pgcopy_chunk_rows(rows: List[Tuple]) -> io.BytesIO:
+    """
+    Build a binary COPY stream of document chunk rows:
+    (datasource_id, document_id, chunk_id, parent_chunk_id, content, metadata JSON text, embedding, is_navigation).
+    """
+    buffer = io.BytesIO()
+    buffer.write(_PGCOPY_HEADER)
+    for datasource_id, document_id, chunk_id, parent_chunk_id, content, metadata, embedding, is_navigation in rows:
+        buffer.write(struct.pack('>hii', 8, 4, datasource_id))
+        buffer.write(_pgcopy_text(document_id))
+        buffer.write(_pgcopy_text(chunk_id))
+        buffer.write(_pgcopy_text(parent_chunk_id))
+        buffer.write(_pgcopy_text(content))
+        # jsonb binary format is a version byte followed by the JSON text
+        data = b'\x01' + metadata.encode('utf-8')
+        buffer.write(struct.pack('>i', len(data)) + data)
+        if embedding is None:
+            buffer.write(_PGCOPY_NULL)
+        else:
+            # pgvector halfvec binary format: dimension, unused, then float2 values
+            dim = len(embedding)
+            buffer.write(struct.pack(f'>iHH{dim}e', 4 + 2 * dim, dim, 0, *embedding))
+        buffer.write(struct.pack('>i?', 1, is_navigation))
+    buffer.write(struct.pack('>h', -1))
+    buffer.seek(0)
+    return buffer
+
+class PrecompiledRecursiveSplitter(RecursiveCharacterTextSplitter):
+    """
+    RecursiveCharacterTextSplitter that compiles its separator patterns once per instance
+    instead of rebuilding them on every split_text call.
+    """
+    
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._separator_patterns = {}
+        for separator in self._separators:
+            pattern = separator if self._is_separator_regex else re.escape(separator)
+            self._separator_patterns[separator] = (
+                re.compile(pattern) if pattern else None,
+                re.compile(f"({pattern})") if pattern else None,
+            )
+    
+    def _split_with_separator(self, text: str, separator: str) -> List[str]:
+        """Split on a precompiled separator, keeping it as the base splitter does."""
+        search_re, capture_re = self._separator_patterns[separator]
+        if search_re is None:
+            return [c for c in text if c]
+        if not self._keep_separator:
+            return [s for s in search_re.split(text) if s]
+        parts = capture_re.split(text)
+        if self._keep_separator == "end":
+            splits = [parts[i] + parts[i + 1] for i in range(0, len(parts) - 1, 2)]
+            if len(parts) % 2 == 0:
+                splits += parts[-1:]
+            splits = splits + [parts[-1]]
+        else:
+            splits = [parts[i] + parts[i + 1] for i in range(1, len(parts), 2)]
+            if len(parts) % 2 == 0:
+                splits += parts[-1:]
+            splits = [parts[0]] + splits
+        return [s for s in splits if s]
+    
+    def _split_text(self, text: str, separators: List[str]) -> List[str]:
+        """Split text recursively, trying separators in priority order."""
+        final_chunks = []
+        # Use the first separator present in the text; finer ones handle oversized pieces
+        separator = separators[-1]
+        new_separators = []
+        for i, candidate in enumerate(separators):
+            search_re = self._separator_patterns[candidate][0]
+            if search_re is None:
+                separator = candidate
+                break
+            if search_re.search(text):
+                separator = candidate
+                new_separators = separators[i + 1:]
+                break
+        
+        splits = self._split_with_separator(text, separator)
+        
+        # Merge small splits; recurse into the ones that are still too long
+        good_splits = []
+        merge_separator = "" if self._keep_separator else separator
+        for split in splits:
+            if self._length_function(split) < self._chunk_size:
+                good_splits.append(split)
+            else:
+                if good_splits:
+                    final_chunks.extend(self._merge_splits(good_splits, merge_separator))
+                    good_splits = []
+                if not new_separators:
+                    final_chunks.append(split)
+                else:
+                    final_chunks.extend(self._split_text(split, new_separators))
+        if good_splits:
+            final_chunks.extend(self._merge_splits(good_splits, merge_separator))
+        return final_chunks
+
+
 class DocumentProcessor:
     """
     A class to process documents of various formats, convert them to markdown,
@@ -44,7 +228,15 @@ class DocumentProcessor:
                     embedding_model: str = "text-embedding-ada-002",
                     api_key: str = None,
                     chunk_size: int = 1000,
-                    chunk_overlap: int = 200):
+                    chunk_overlap: int = 200,
+                    embedding_batch_size: int = 100,
+                    max_concurrent_embedding_batches: int = 5,
+                    embedding_cache_size: int = 5000,
+                    query_cache_size: int = 512,
+                    ocr_workers: Optional[int] = None,
+                    gpu: bool = True,
+                    postgres_max_connections: int = 16,
+                    hnsw_ef_search: int = 40):
         """
         Initialize the DocumentProcessor with configuration for database and embedding model.
         
@@ -56,21 +248,39 @@ class DocumentProcessor:
             api_key: API key for embedding model (if needed)
             chunk_size: Size of text chunks for embedding
             chunk_overlap: Overlap between chunks
+            embedding_batch_size: Number of chunks embedded per API request
+            max_concurrent_embedding_batches: Embedding requests in flight at once (async processing)
+            embedding_cache_size: Number of embeddings kept in the in-memory cache
+            query_cache_size: Number of search query embeddings kept in memory
+            ocr_workers: Processes used to OCR scanned PDF pages (defaults to min(CPU count, 6));
+                1 OCRs them in a single in-process batch
+            gpu: Run EasyOCR on the GPU when one is available
+            postgres_max_connections: Size limit of the PostgreSQL connection pool
+            hnsw_ef_search: HNSW candidate list size for PostgreSQL searches (higher trades latency for recall)
         """
         self.db_type = db_type.lower()
         self.chroma_persist_directory = chroma_persist_directory
         self.postgres_connection_string = postgres_connection_string
+        self.postgres_max_connections = postgres_max_connections
+        self.hnsw_ef_search = hnsw_ef_search
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.embedding_batch_size = embedding_batch_size
+        self.max_concurrent_embedding_batches = max_concurrent_embedding_batches
+        self.ocr_workers = ocr_workers if ocr_workers is not None else min(os.cpu_count() or 1, 6)
+        self.gpu = gpu
         
-        # Initialize embedding model
+        # Embedding model, OCR readers and Chroma client are created on first use (see the properties below)
         if api_key:
             os.environ["OPENAI_API_KEY"] = api_key
-        self.embeddings = OpenAIEmbeddings(model=embedding_model)
-        
-        # Initialize OCR readers
-        self.easyocr_reader = easyocr.Reader(['en'])
-        self.colpali = Colpali()  # Initialize Colpali
+        self.embedding_model = embedding_model
+        # Content-hash -> embedding; backed by the embedding_cache table when using PostgreSQL
+        self._embedding_cache = LRUCache(maxsize=embedding_cache_size)
+        # Query text -> embedding for search(); the lock keeps hit/miss counts consistent across threads
+        self._query_cache = LRUCache(maxsize=query_cache_size)
+        self._query_cache_lock = threading.Lock()
+        self._query_cache_hits = 0
+        self._query_cache_misses = 0
         
         # Initialize database connection
         if self.db_type == "chroma":
@@ -81,60 +291,153 @@ class DocumentProcessor:
             raise ValueError(f"Unsupported database type: {db_type}")
             
         # Initialize text splitter for chunking
-        self.text_splitter = RecursiveCharacterTextSplitter(
+        self.text_splitter = PrecompiledRecursiveSplitter(
             chunk_size=self.chunk_size,
             chunk_overlap=self.chunk_overlap,
             length_function=len
         )
     
-    def _init_chroma(self):
-        """Initialize Chroma database connection."""
+    @cached_property
+    def embeddings(self) -> OpenAIEmbeddings:
+        """Embedding model client."""
+        return OpenAIEmbeddings(model=self.embedding_model)
+    
+    @cached_property
+    def easyocr_reader(self) -> easyocr.Reader:
+        """EasyOCR reader; loading its models takes seconds, so search-only callers never pay for it."""
+        reader = easyocr.Reader(['en'], gpu=self.gpu, cudnn_benchmark=True)
+        if str(reader.device) != 'cpu':
+            # Prime the kernels picked by cudnn_benchmark so the first real batch isn't slowed by tuning
+            reader.readtext_batched(np.zeros((4, 600, 800, 3), dtype=np.uint8))
+        return reader
+    
+    @cached_property
+    def _ocr_on_gpu(self) -> bool:
+        """Whether EasyOCR runs on a GPU; answered without building the reader, which CPU worker processes load themselves."""
+        return bool(self.gpu) and torch.cuda.is_available()
+    
+    @cached_property
+    def colpali(self) -> Colpali:
+        """Colpali extractor."""
+        return Colpali()
+    
+    @cached_property
+    def chroma_client(self):
+        """Persistent Chroma client."""
         os.makedirs(self.chroma_persist_directory, exist_ok=True)
-        self.chroma_client = chromadb.PersistentClient(path=self.chroma_persist_directory)
+        client = chromadb.PersistentClient(path=self.chroma_persist_directory)
         logger.info(f"Initialized Chroma DB at {self.chroma_persist_directory}")
+        return client
+    
+    def _init_chroma(self):
+        """Prepare Chroma state; the client itself is opened on first use."""
+        self._collection_cache: Dict[str, Any] = {}
+    
+    def _get_collection(self, name: str):
+        """Get or create a Chroma collection, memoized so repeat operations skip the metadata lookup."""
+        collection = self._collection_cache.get(name)
+        if collection is None:
+            collection = self.chroma_client.get_or_create_collection(name)
+            self._collection_cache[name] = collection
+        return collection
     
     def _init_postgres(self):
         """Initialize PostgreSQL database connection."""
         if not self.postgres_connection_string:
             raise ValueError("Postgres connection string is required for PostgreSQL database")
         
-        self.pg_conn = psycopg2.connect(self.postgres_connection_string)
-        self.pg_cursor = self.pg_conn.cursor()
-        
-        # Create tables if they don't exist
-        self.pg_cursor.execute("""
-            CREATE TABLE IF NOT EXISTS accounts (
-                id SERIAL PRIMARY KEY,
-                name VARCHAR(255) UNIQUE NOT NULL
-            )
-        """)
-        
-        self.pg_cursor.execute("""
-            CREATE TABLE IF NOT EXISTS datasources (
-                id SERIAL PRIMARY KEY,
-                account_id INTEGER REFERENCES accounts(id),
-                name VARCHAR(255) NOT NULL,
-                UNIQUE(account_id, name)
-            )
-        """)
-        
-        self.pg_cursor.execute("""
-            CREATE TABLE IF NOT EXISTS document_chunks (
-                id SERIAL PRIMARY KEY,
-                datasource_id INTEGER REFERENCES datasources(id),
-                document_id VARCHAR(255) NOT NULL,
-                chunk_id VARCHAR(255) NOT NULL,
-                parent_chunk_id VARCHAR(255),
-                content TEXT NOT NULL,
-                metadata JSONB,
-                embedding VECTOR(1536),
-                UNIQUE(datasource_id, chunk_id)
-            )
-        """)
+        # Connections are borrowed per operation so threads (e.g. process_document_async) don't share a cursor
+        self._pg_pool = ThreadedConnectionPool(1, self.postgres_max_connections, self.postgres_connection_string)
+        # Pooled connections that already hold _PG_PREPARED_STATEMENTS
+        self._pg_prepared = weakref.WeakSet()
+        
+        with self._pg_cursor() as cursor:
+            # Create tables if they don't exist
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS accounts (
+                    id SERIAL PRIMARY KEY,
+                    name VARCHAR(255) UNIQUE NOT NULL
+                )
+            """)
+        
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS datasources (
+                    id SERIAL PRIMARY KEY,
+                    account_id INTEGER REFERENCES accounts(id),
+                    name VARCHAR(255) NOT NULL,
+                    UNIQUE(account_id, name)
+                )
+            """)
+        
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS document_chunks (
+                    id SERIAL PRIMARY KEY,
+                    datasource_id INTEGER REFERENCES datasources(id),
+                    document_id VARCHAR(255) NOT NULL,
+                    chunk_id VARCHAR(255) NOT NULL,
+                    parent_chunk_id VARCHAR(255),
+                    content TEXT NOT NULL,
+                    metadata JSONB,
+                    embedding HALFVEC(1536),
+                    is_navigation BOOLEAN NOT NULL DEFAULT FALSE,
+                    UNIQUE(datasource_id, chunk_id)
+                )
+            """)
+            cursor.execute("ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS is_navigation BOOLEAN NOT NULL DEFAULT FALSE")
+            
+            # Embeddings are stored as FP16 halfvec, halving the bytes every search scans; migrate older FP32 tables
+            cursor.execute("""
+                SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = 'document_chunks'::regclass AND attname = 'embedding'
+            """)
+            if not cursor.fetchone()[0].startswith('halfvec'):
+                cursor.execute("DROP INDEX IF EXISTS document_chunks_embedding_hnsw")
+                cursor.execute("ALTER TABLE document_chunks ALTER COLUMN embedding TYPE HALFVEC(1536) USING embedding::halfvec(1536)")
+            
+            # Delete filters on document_id and related-chunk lookups on parent_chunk_id, both within a datasource
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunks_ds_doc ON document_chunks (datasource_id, document_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunks_ds_parent ON document_chunks (datasource_id, parent_chunk_id)")
+            
+            # Approximate nearest-neighbour index so searches don't scan every embedding
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS document_chunks_embedding_hnsw
+                ON document_chunks USING hnsw (embedding halfvec_cosine_ops)
+                WITH (m = 16, ef_construction = 64)
+            """)
+        
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    hash BYTEA NOT NULL,
+                    model VARCHAR(255) NOT NULL,
+                    embedding VECTOR(1536) NOT NULL,
+                    PRIMARY KEY(hash, model)
+                )
+            """)
         
-        self.pg_conn.commit()
         logger.info("Initialized PostgreSQL connection and tables")
     
+    @contextmanager
+    def _pg_cursor(self):
+        """Borrow a pooled connection for one unit of work, committing on success and rolling back on error."""
+        conn = self._pg_pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pg_pool.putconn(conn)
+    
+    def _ensure_prepared(self, cursor) -> None:
+        """Prepare the read statements on the cursor's connection if its session doesn't have them yet."""
+        if cursor.connection in self._pg_prepared:
+            return
+        for statement in _PG_PREPARED_STATEMENTS.values():
+            cursor.execute(statement)
+        self._pg_prepared.add(cursor.connection)
+    
     def process_document(self, 
                             file_path: str, 
                             account_name: str, 
@@ -167,6 +470,42 @@ class DocumentProcessor:
         
         return document_id
     
+    async def process_document_async(self, 
+                                        file_path: str, 
+                                        account_name: str, 
+                                        datasource_name: str,
+                                        metadata: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Async variant of process_document that embeds chunk batches concurrently.
+        Conversion and storage run in worker threads so the event loop is not blocked.
+        
+        Args:
+            file_path: Path to the document file
+            account_name: Account name for hierarchical storage
+            datasource_name: Datasource name for hierarchical storage
+            metadata: Additional metadata for the document
+            
+        Returns:
+            Document ID of the processed document
+        """
+        # Generate a unique document ID
+        document_id = str(uuid.uuid4())
+        
+        # Extract text from document based on file type
+        file_extension = os.path.splitext(file_path)[1].lower()
+        markdown_text = await asyncio.to_thread(self._convert_to_markdown, file_path, file_extension)
+        
+        # Create hierarchical chunks
+        chunks = self._create_hierarchical_chunks(markdown_text)
+        
+        # Store embeddings
+        embeddings = await self._aembed_chunks(chunks)
+        await asyncio.to_thread(
+            self._store_embeddings, chunks, document_id, account_name, datasource_name, metadata, embeddings
+        )
+        
+        return document_id
+    
     def _convert_to_markdown(self, file_path: str, file_extension: str) -> str:
         """
         Convert document to markdown format based on file extension.
@@ -193,15 +532,9 @@ class DocumentProcessor:
             elif file_extension == '.csv':
                 return self._process_csv(file_path)
             
-            elif file_extension == '.txt':
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    text = file.read()
-                return text
-            
-            elif file_extension == '.md':
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    text = file.read()
-                return text
+            elif file_extension in ['.txt', '.md']:
+                # Decode the whole file in one call; undecodable bytes shouldn't fail the ingest
+                return Path(file_path).read_text(encoding='utf-8', errors='replace')
             
             else:
                 raise ValueError(f"Unsupported file extension: {file_extension}")
@@ -246,28 +579,63 @@ class DocumentProcessor:
         # Check if the PDF has text content or is scanned
         with open(file_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                page_text = page.extract_text()
-                
-                # If page has no text, it might be scanned - use OCR
-                if not page_text or len(page_text.strip()) < 50:
-                    # Convert PDF page to image and use OCR
-                    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_file:
-                        temp_image_path = temp_file.name
-                    
-                    # This is a simplified approach - would need to use a library like pdf2image in practice
-                    img = Image.open(file_path)
-                    img.save(temp_image_path)
-                    
-                    page_text = self._process_image(temp_image_path)
-                    os.unlink(temp_image_path)
-                
-                text += f"\n\n--- Page {page_num + 1} ---\n\n{page_text}"
-                
-        return text
+            page_texts = [page.extract_text() for page in pdf_reader.pages]
+            has_fonts = [self._page_has_fonts(page) for page in pdf_reader.pages]
+        
+        text_rich = [bool(page_text) and len(page_text.strip()) >= 50 for page_text in page_texts]
+        if sum(text_rich) >= 0.95 * len(page_texts):
+            # Born-digital document: the extracted text is complete, skip OCR entirely
+            ocr_idx = []
+        else:
+            # If page has no text and no fonts to draw any, it is scanned - use OCR
+            ocr_idx = [i for i, rich in enumerate(text_rich) if not rich and not has_fonts[i]]
+        if ocr_idx:
+            # Rasterize only the pages that need OCR and OCR them together in one batch
+            for i, page_text in zip(ocr_idx, self._ocr_pages(self._rasterize_pages(file_path, ocr_idx))):
+                page_texts[i] = page_text
+        
+        return "".join(f"\n\n--- Page {page_num + 1} ---\n\n{page_text}"
+                       for page_num, page_text in enumerate(page_texts))
+    
+    @staticmethod
+    def _rasterize_pages(file_path: str, page_indices: List[int]) -> List[Image.Image]:
+        """Rasterizes the given 0-based pages (ascending), one convert_from_path call per contiguous run."""
+        images = []
+        for _, run in itertools.groupby(enumerate(page_indices), key=lambda pair: pair[1] - pair[0]):
+            pages = [page_index for _, page_index in run]
+            images.extend(convert_from_path(file_path, dpi=200, first_page=pages[0] + 1, last_page=pages[-1] + 1))
+        return images
+    
+    @staticmethod
+    def _page_has_fonts(page) -> bool:
+        """Whether a PDF page declares a font map, i.e. carries real text objects."""
+        resources = page.get('/Resources')
+        return resources is not None and '/Font' in resources.get_object()
+    
+    def _ocr_pages(self, images: List[Image.Image]) -> List[str]:
+        """OCR rasterized PDF pages in a single EasyOCR batch, falling back to Tesseract for empty pages."""
+        # A GPU handles the batch itself; worker processes would only contend for it
+        if not self._ocr_on_gpu and self.ocr_workers > 1 and len(images) > 1:
+            # OCR is CPU-bound, so spread pages across processes; spawn keeps torch state out of the workers
+            with ProcessPoolExecutor(max_workers=min(self.ocr_workers, len(images)),
+                                     mp_context=multiprocessing.get_context("spawn")) as executor:
+                return list(executor.map(_ocr_one_page, [np.array(image) for image in images]))
+        
+        try:
+            # Batched inference needs a common input size; pages are resized to it
+            results = self.easyocr_reader.readtext_batched(
+                [np.array(image) for image in images], n_width=1600, n_height=2000
+            )
+            page_texts = ["\n\n".join(text for _, text, _ in result) for result in results]
+        except Exception as e:
+            logger.warning(f"EasyOCR batch failed: {str(e)}")
+            page_texts = [""] * len(images)
+        
+        # Fall back to Tesseract
+        for i, page_text in enumerate(page_texts):
+            if not page_text.strip():
+                page_texts[i] = pytesseract.image_to_string(images[i])
+        return page_texts
     
     def _process_docx(self, file_path: str) -> str:
         """Process DOCX file and convert to markdown."""
@@ -294,7 +662,11 @@ class DocumentProcessor:
         logger.info(f"Processing CSV: {file_path}")
         
         try:
-            df = pd.read_csv(file_path)
+            # pyarrow's multithreaded parser is much faster on large files
+            try:
+                df = pd.read_csv(file_path, engine="pyarrow")
+            except ImportError:
+                df = pd.read_csv(file_path)
             markdown_table = df.to_markdown(index=False)
             return markdown_table
         except Exception as e:
@@ -315,58 +687,72 @@ class DocumentProcessor:
         
         # First level: Split by major sections (e.g., headers)
         # This is a simplified approach - would need more sophisticated parsing for real docs
-        sections = []
-        current_section = ""
-        
-        for line in text.split('\n'):
-            if line.startswith('# '):  # Major section header
-                if current_section:
-                    sections.append(current_section)
-                current_section = line + '\n'
-            else:
-                current_section += line + '\n'
-                
-        if current_section:
-            sections.append(current_section)
+        sections = [section for section in _SECTION_RE.split(text) if section.strip()]
+        
+        # Further split each section into smaller chunks
+        section_chunks = [self.text_splitter.split_text(section) for section in sections]
+        
+        # Draw every chunk ID from a single random read instead of one uuid4() call per chunk
+        chunk_ids = self._generate_chunk_ids(1 + len(sections) + sum(len(split) for split in section_chunks))
             
         # Create hierarchical chunks
         chunks = []
         
         # Create a parent chunk for the entire document
-        parent_chunk_id = str(uuid.uuid4())
+        # Parents are navigation only: they hold a title instead of a copy of the text and are not embedded
+        parent_chunk_id = next(chunk_ids)
         chunks.append({
-            'content': text[:1000] + '...' if len(text) > 1000 else text,  # Truncated overview
+            'content': self._chunk_title(text),
             'chunk_id': parent_chunk_id,
-            'parent_chunk_id': None
+            'parent_chunk_id': None,
+            'is_navigation': True
         })
         
         # Create child chunks for each section
-        for section in sections:
+        for section, split in zip(sections, section_chunks):
             # Create a section parent
-            section_id = str(uuid.uuid4())
+            section_id = next(chunk_ids)
             chunks.append({
-                'content': section[:1000] + '...' if len(section) > 1000 else section,
+                'content': self._chunk_title(section),
                 'chunk_id': section_id,
-                'parent_chunk_id': parent_chunk_id
+                'parent_chunk_id': parent_chunk_id,
+                'is_navigation': True
             })
             
-            # Further split the section into smaller chunks
-            section_chunks = self.text_splitter.split_text(section)
-            for chunk in section_chunks:
+            for chunk in split:
                 chunks.append({
                     'content': chunk,
-                    'chunk_id': str(uuid.uuid4()),
-                    'parent_chunk_id': section_id
+                    'chunk_id': next(chunk_ids),
+                    'parent_chunk_id': section_id,
+                    'is_navigation': False
                 })
                 
         return chunks
     
+    @staticmethod
+    def _chunk_title(text: str) -> str:
+        """Title for a navigation chunk: the first non-empty line, without markdown header marks."""
+        for line in text.splitlines():
+            title = line.strip().lstrip('#').strip()
+            if title:
+                return title[:200]
+        return "Untitled"
+
+    
+    @staticmethod
+    def _generate_chunk_ids(count: int):
+        """Yield count random (version 4) UUID strings generated from one os.urandom call."""
+        raw = os.urandom(16 * count)
+        for i in range(count):
+            yield str(uuid.UUID(bytes=raw[i * 16:(i + 1) * 16], version=4))
+    
     def _store_embeddings(self, 
                             chunks: List[Dict[str, Any]], 
                             document_id: str,
                             account_name: str, 
                             datasource_name: str,
-                            metadata: Optional[Dict[str, Any]] = None) -> None:
+                            metadata: Optional[Dict[str, Any]] = None,
+                            embeddings: Optional[List[Optional[List[float]]]] = None) -> None:
         """
         Store embeddings in the database with hierarchical context.
         
@@ -376,6 +762,7 @@ class DocumentProcessor:
             account_name: Account name for hierarchical storage
             datasource_name: Datasource name for hierarchical storage
             metadata: Additional metadata for the document
+            embeddings: Precomputed chunk embeddings; generated here if not given
         """
         if metadata is None:
             metadata = {}
@@ -383,13 +770,123 @@ class DocumentProcessor:
         # Add document_id to metadata
         metadata['document_id'] = document_id
         
+        # Generate all embeddings up front, one request per batch instead of per chunk
+        if embeddings is None:
+            embeddings = self._embed_chunks(chunks)
+        
         if self.db_type == "chroma":
-            self._store_in_chroma(chunks, document_id, account_name, datasource_name, metadata)
+            self._store_in_chroma(chunks, embeddings, document_id, account_name, datasource_name, metadata)
         else:
-            self._store_in_postgres(chunks, document_id, account_name, datasource_name, metadata)
+            self._store_in_postgres(chunks, embeddings, document_id, account_name, datasource_name, metadata)
+    
+    def _embed_chunks(self, chunks: List[Dict[str, Any]]) -> List[Optional[List[float]]]:
+        """Embed chunk contents, preserving chunk order; navigation chunks get None."""
+        embeddable = [i for i, chunk in enumerate(chunks) if not chunk.get('is_navigation')]
+        embeddings = self._embed_cached([chunks[i]['content'] for i in embeddable])
+        return self._scatter_embeddings(len(chunks), embeddable, embeddings)
+    
+    def _embed_cached(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts in batches of embedding_batch_size, preserving order.
+        Texts already embedded with this model (by SHA-256 of their content) are served from the cache.
+        """
+        hashes = [hashlib.sha256(text.encode('utf-8')).digest() for text in texts]
+        embeddings = self._get_cached_embeddings(hashes)
+        
+        # Only embed chunks whose content has not been embedded before
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        missing_texts = [texts[i] for i in missing]
+        new_embeddings = []
+        for start in range(0, len(missing_texts), self.embedding_batch_size):
+            new_embeddings.extend(self.embeddings.embed_documents(missing_texts[start:start + self.embedding_batch_size]))
+        
+        self._cache_embeddings([hashes[i] for i in missing], new_embeddings)
+        for i, embedding in zip(missing, new_embeddings):
+            embeddings[i] = embedding
+        return embeddings
+    
+    async def _aembed_chunks(self, chunks: List[Dict[str, Any]]) -> List[Optional[List[float]]]:
+        """Embed chunk batches concurrently, capped at max_concurrent_embedding_batches, preserving chunk order."""
+        embeddable = [i for i, chunk in enumerate(chunks) if not chunk.get('is_navigation')]
+        texts = [chunks[i]['content'] for i in embeddable]
+        hashes = [hashlib.sha256(text.encode('utf-8')).digest() for text in texts]
+        embeddings = await asyncio.to_thread(self._get_cached_embeddings, hashes)
+        
+        # Only embed chunks whose content has not been embedded before
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        missing_texts = [texts[i] for i in missing]
+        batches = [missing_texts[start:start + self.embedding_batch_size]
+                   for start in range(0, len(missing_texts), self.embedding_batch_size)]
+        results: List[List[List[float]]] = [[] for _ in batches]
+        semaphore = asyncio.Semaphore(self.max_concurrent_embedding_batches)
+        
+        async def embed_batch(index: int, batch: List[str]):
+            async with semaphore:
+                results[index] = await self.embeddings.aembed_documents(batch)
+        
+        await asyncio.gather(*(embed_batch(index, batch) for index, batch in enumerate(batches)))
+        new_embeddings = [embedding for batch_embeddings in results for embedding in batch_embeddings]
+        
+        await asyncio.to_thread(self._cache_embeddings, [hashes[i] for i in missing], new_embeddings)
+        for i, embedding in zip(missing, new_embeddings):
+            embeddings[i] = embedding
+        return self._scatter_embeddings(len(chunks), embeddable, embeddings)
+    
+    @staticmethod
+    def _scatter_embeddings(count: int, positions: List[int], embeddings: List[List[float]]) -> List[Optional[List[float]]]:
+        """Place embeddings at their chunk positions, leaving None for chunks that were not embedded."""
+        aligned: List[Optional[List[float]]] = [None] * count
+        for position, embedding in zip(positions, embeddings):
+            aligned[position] = embedding
+        return aligned
+    
+    def _get_cached_embeddings(self, hashes: List[bytes]) -> List[Optional[List[float]]]:
+        """Look up embeddings by content hash, in memory first and then in PostgreSQL; None marks a miss."""
+        embeddings = [self._embedding_cache.get(content_hash) for content_hash in hashes]
+        missing = list({hashes[i] for i, embedding in enumerate(embeddings) if embedding is None})
+        
+        if missing and self.db_type == "postgres":
+            with self._pg_cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT hash, embedding::real[] FROM embedding_cache
+                    WHERE model = %s AND hash = ANY(%s)
+                    """,
+                    (self.embedding_model, [psycopg2.Binary(content_hash) for content_hash in missing])
+                )
+                for content_hash, embedding in cursor.fetchall():
+                    self._embedding_cache[bytes(content_hash)] = embedding
+            embeddings = [embedding if embedding is not None else self._embedding_cache.get(content_hash)
+                          for content_hash, embedding in zip(hashes, embeddings)]
+        
+        logger.info(f"Embedding cache hits: {sum(embedding is not None for embedding in embeddings)}/{len(hashes)}")
+        return embeddings
+    
+    def _cache_embeddings(self, hashes: List[bytes], embeddings: List[List[float]]) -> None:
+        """Write newly generated embeddings back to the in-memory and PostgreSQL caches."""
+        if not hashes:
+            return
+        
+        for content_hash, embedding in zip(hashes, embeddings):
+            self._embedding_cache[content_hash] = embedding
+        
+        if self.db_type == "postgres":
+            with self._pg_cursor() as cursor:
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO embedding_cache (hash, model, embedding)
+                    VALUES %s
+                    ON CONFLICT (hash, model) DO NOTHING
+                    """,
+                    [(psycopg2.Binary(content_hash), self.embedding_model, embedding)
+                     for content_hash, embedding in zip(hashes, embeddings)],
+                    page_size=500
+                )
     
     def _store_in_chroma(self, 
                             chunks: List[Dict[str, Any]], 
+                            embeddings: List[Optional[List[float]]],
                             document_id: str,
                             account_name: str, 
                             datasource_name: str,
@@ -397,35 +894,48 @@ class DocumentProcessor:
         """Store embeddings in Chroma DB."""
         logger.info(f"Storing embeddings in Chroma DB for document {document_id}")
         
-        # Create a collection for the account/datasource if it doesn't exist
-        collection_name = f"{account_name}_{datasource_name}"
-        collection = self.chroma_client.get_or_create_collection(collection_name)
-        
-        # Process chunks and store them
+        # One collection per account; datasources are told apart by the 'datasource' metadata
+        collection = self._get_collection(account_name)
+        
+        # Chroma needs a vector for every record; navigation chunks get a zero vector and are filtered out of searches
+        dimension = next((len(embedding) for embedding in embeddings if embedding is not None), 0)
+        if not dimension:
+            logger.warning(f"No content chunks to store for document {document_id}")
+            return
+        navigation_embedding = [0.0] * dimension
+        embeddings = [embedding if embedding is not None else navigation_embedding for embedding in embeddings]
+        
+        # Process chunks into parallel lists for batched adds
+        ids = []
+        metadatas = []
+        documents = []
         for chunk in chunks:
-            chunk_metadata = {
+            ids.append(chunk['chunk_id'])
+            metadatas.append({
                 **metadata,
                 'chunk_id': chunk['chunk_id'],
                 'parent_chunk_id': chunk['parent_chunk_id'],
+                'is_navigation': chunk.get('is_navigation', False),
                 'account': account_name,
                 'datasource': datasource_name
-            }
-            
-            # Generate embedding
-            embedding = self.embeddings.embed_query(chunk['content'])
-            
-            # Add document to collection
+            })
+            documents.append(chunk['content'])
+        
+        # Add documents to collection, within Chroma's batch size limit
+        for start in range(0, len(ids), CHROMA_MAX_BATCH_SIZE):
+            end = start + CHROMA_MAX_BATCH_SIZE
             collection.add(
-                ids=[chunk['chunk_id']],
-                embeddings=[embedding],
-                metadatas=[chunk_metadata],
-                documents=[chunk['content']]
+                ids=ids[start:end],
+                embeddings=embeddings[start:end],
+                metadatas=metadatas[start:end],
+                documents=documents[start:end]
             )
             
         logger.info(f"Stored {len(chunks)} chunks in Chroma DB")
     
     def _store_in_postgres(self, 
                             chunks: List[Dict[str, Any]], 
+                            embeddings: List[Optional[List[float]]],
                             document_id: str,
                             account_name: str, 
                             datasource_name: str,
@@ -433,75 +943,107 @@ class DocumentProcessor:
         """Store embeddings in PostgreSQL database."""
         logger.info(f"Storing embeddings in PostgreSQL for document {document_id}")
         
-        # Get or create account
-        self.pg_cursor.execute(
-            "INSERT INTO accounts (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id",
-            (account_name,)
-        )
-        result = self.pg_cursor.fetchone()
-        if result:
-            account_id = result[0]
-        else:
-            self.pg_cursor.execute("SELECT id FROM accounts WHERE name = %s", (account_name,))
-            account_id = self.pg_cursor.fetchone()[0]
-        
-        # Get or create datasource
-        self.pg_cursor.execute(
-            """
-            INSERT INTO datasources (account_id, name) 
-            VALUES (%s, %s) ON CONFLICT (account_id, name) DO NOTHING RETURNING id
-            """,
-            (account_id, datasource_name)
-        )
-        result = self.pg_cursor.fetchone()
-        if result:
-            datasource_id = result[0]
-        else:
-            self.pg_cursor.execute(
-                "SELECT id FROM datasources WHERE account_id = %s AND name = %s",
+        with self._pg_cursor() as cursor:
+            # Get or create account
+            cursor.execute(
+                "INSERT INTO accounts (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id",
+                (account_name,)
+            )
+            result = cursor.fetchone()
+            if result:
+                account_id = result[0]
+            else:
+                cursor.execute("SELECT id FROM accounts WHERE name = %s", (account_name,))
+                account_id = cursor.fetchone()[0]
+        
+            # Get or create datasource
+            cursor.execute(
+                """
+                INSERT INTO datasources (account_id, name) 
+                VALUES (%s, %s) ON CONFLICT (account_id, name) DO NOTHING RETURNING id
+                """,
                 (account_id, datasource_name)
             )
-            datasource_id = self.pg_cursor.fetchone()[0]
+            result = cursor.fetchone()
+            if result:
+                datasource_id = result[0]
+            else:
+                cursor.execute(
+                    "SELECT id FROM datasources WHERE account_id = %s AND name = %s",
+                    (account_id, datasource_name)
+                )
+                datasource_id = cursor.fetchone()[0]
         
-        # Process chunks and store them
-        for chunk in chunks:
-            chunk_metadata = {
+            # Every chunk carries the same metadata, so serialize it once
+            chunk_metadata = json.dumps({
                 **metadata,
                 'account': account_name,
                 'datasource': datasource_name
-            }
-            
-            # Generate embedding
-            embedding = self.embeddings.embed_query(chunk['content'])
-            
-            # Add document to database
-            self.pg_cursor.execute(
-                """
-                INSERT INTO document_chunks 
-                (datasource_id, document_id, chunk_id, parent_chunk_id, content, metadata, embedding)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (datasource_id, chunk_id) 
-                DO UPDATE SET 
-                    document_id = EXCLUDED.document_id,
-                    parent_chunk_id = EXCLUDED.parent_chunk_id,
-                    content = EXCLUDED.content,
-                    metadata = EXCLUDED.metadata,
-                    embedding = EXCLUDED.embedding
-                """,
+            })
+            rows = [
                 (
                     datasource_id,
                     document_id,
                     chunk['chunk_id'],
                     chunk['parent_chunk_id'],
                     chunk['content'],
-                    Json(chunk_metadata),
-                    embedding
+                    chunk_metadata,
+                    embedding,
+                    chunk.get('is_navigation', False)
+                )
+                for chunk, embedding in zip(chunks, embeddings)
+            ]
+        
+            if len(rows) >= COPY_MIN_CHUNKS:
+                self._copy_chunks(cursor, rows)
+            else:
+                # Add all chunks in multi-row upserts instead of one statement per chunk
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO document_chunks 
+                    (datasource_id, document_id, chunk_id, parent_chunk_id, content, metadata, embedding, is_navigation)
+                    VALUES %s
+                    ON CONFLICT (datasource_id, chunk_id) 
+                    DO UPDATE SET 
+                        document_id = EXCLUDED.document_id,
+                        parent_chunk_id = EXCLUDED.parent_chunk_id,
+                        content = EXCLUDED.content,
+                        metadata = EXCLUDED.metadata,
+                        embedding = EXCLUDED.embedding,
+                        is_navigation = EXCLUDED.is_navigation
+                    """,
+                    rows,
+                    template="(%s, %s, %s, %s, %s, %s::jsonb, %s::halfvec, %s)",
+                    page_size=500
                 )
-            )
         
-        self.pg_conn.commit()
         logger.info(f"Stored {len(chunks)} chunks in PostgreSQL")
     
+    @staticmethod
+    def _copy_chunks(cursor, rows: List[Tuple]) -> None:
+        """Bulk-load chunk rows with binary COPY into a staging table, then upsert them in one statement."""
+        cursor.execute("""
+            CREATE TEMP TABLE document_chunks_stage ON COMMIT DROP AS
+            SELECT datasource_id, document_id, chunk_id, parent_chunk_id, content, metadata, embedding, is_navigation
+            FROM document_chunks WITH NO DATA
+        """)
+        cursor.copy_expert("COPY document_chunks_stage FROM STDIN WITH (FORMAT binary)", _pgcopy_chunk_rows(rows))
+        cursor.execute("""
+            INSERT INTO document_chunks 
+            (datasource_id, document_id, chunk_id, parent_chunk_id, content, metadata, embedding, is_navigation)
+            SELECT datasource_id, document_id, chunk_id, parent_chunk_id, content, metadata, embedding, is_navigation
+            FROM document_chunks_stage
+            ON CONFLICT (datasource_id, chunk_id) 
+            DO UPDATE SET 
+                document_id = EXCLUDED.document_id,
+                parent_chunk_id = EXCLUDED.parent_chunk_id,
+                content = EXCLUDED.content,
+                metadata = EXCLUDED.metadata,
+                embedding = EXCLUDED.embedding,
+                is_navigation = EXCLUDED.is_navigation
+        """)
+    
     def search(self, 
                 query: str, 
                 account_name: str, 
@@ -522,52 +1064,55 @@ class DocumentProcessor:
         logger.info(f"Searching for '{query}' in account '{account_name}'")
         
         # Generate embedding for the query
-        query_embedding = self.embeddings.embed_query(query)
+        query_embedding = self._embed_query(query)
         
         if self.db_type == "chroma":
             return self._search_in_chroma(query_embedding, account_name, datasource_name, limit)
         else:
             return self._search_in_postgres(query_embedding, account_name, datasource_name, limit)
     
+    def _embed_query(self, query: str) -> List[float]:
+        """Embed a search query, reusing the embedding of a recently seen identical query."""
+        with self._query_cache_lock:
+            query_embedding = self._query_cache.get(query)
+            if query_embedding is not None:
+                self._query_cache_hits += 1
+                return query_embedding
+            self._query_cache_misses += 1
+        
+        # Falls through to the content-hash cache, which also covers queries seen before a restart
+        query_embedding = self._embed_cached([query])[0]
+        with self._query_cache_lock:
+            self._query_cache[query] = query_embedding
+        return query_embedding
+    
+    def search_cache_stats(self) -> Dict[str, int]:
+        """Hit/miss counters and occupancy of the search query embedding cache."""
+        with self._query_cache_lock:
+            return {
+                "hits": self._query_cache_hits,
+                "misses": self._query_cache_misses,
+                "size": len(self._query_cache),
+                "maxsize": int(self._query_cache.maxsize)
+            }
+    
     def _search_in_chroma(self, 
                             query_embedding: List[float], 
                             account_name: str, 
                             datasource_name: str = None,
                             limit: int = 5) -> List[Dict[str, Any]]:
         """Search for similar documents in Chroma DB."""
+        # A single index search over the account's collection, narrowed by metadata
+        where: Dict[str, Any] = {"is_navigation": False}
         if datasource_name:
-            collection_name = f"{account_name}_{datasource_name}"
-            collection = self.chroma_client.get_or_create_collection(collection_name)
-            
-            # Query the collection
-            results = collection.query(
-                query_embeddings=[query_embedding],
-                n_results=limit,
-                include=["metadatas", "documents", "distances"]
-            )
-        else:
-            # Search across all datasources for the account
-            all_results = []
-            
-            for collection in self.chroma_client.list_collections():
-                if collection.name.startswith(f"{account_name}_"):
-                    result = collection.query(
-                        query_embeddings=[query_embedding],
-                        n_results=limit,
-                        include=["metadatas", "documents", "distances"]
-                    )
-                    
-                    for i in range(len(result["ids"][0])):
-                        all_results.append({
-                            "id": result["ids"][0][i],
-                            "metadata": result["metadatas"][0][i],
-                            "content": result["documents"][0][i],
-                            "distance": result["distances"][0][i]
-                        })
-            
-            # Sort by distance and limit results
-            all_results.sort(key=lambda x: x["distance"])
-            return all_results[:limit]
+            where = {"$and": [where, {"datasource": datasource_name}]}
+        
+        results = self._get_collection(account_name).query(
+            query_embeddings=[query_embedding],
+            n_results=limit,
+            where=where,
+            include=["metadatas", "documents", "distances"]
+        )
         
         # Format results
         formatted_results = []
@@ -587,76 +1132,85 @@ class DocumentProcessor:
                             datasource_name: str = None,
                             limit: int = 5) -> List[Dict[str, Any]]:
         """Search for similar documents in PostgreSQL database."""
-        # Get account ID
-        self.pg_cursor.execute("SELECT id FROM accounts WHERE name = %s", (account_name,))
-        result = self.pg_cursor.fetchone()
-        if not result:
-            logger.warning(f"Account '{account_name}' not found")
-            return []
-        
-        account_id = result[0]
-        
-        # Build the query
-        if datasource_name:
-            self.pg_cursor.execute(
-                """
-                SELECT id FROM datasources WHERE account_id = %s AND name = %s
-                """,
-                (account_id, datasource_name)
-            )
-            result = self.pg_cursor.fetchone()
+        with self._pg_cursor() as cursor:
+            # Get account ID
+            cursor.execute("SELECT id FROM accounts WHERE name = %s", (account_name,))
+            result = cursor.fetchone()
             if not result:
-                logger.warning(f"Datasource '{datasource_name}' not found for account '{account_name}'")
+                logger.warning(f"Account '{account_name}' not found")
                 return []
+        
+            account_id = result[0]
+        
+            # HNSW search breadth; SET LOCAL only lasts for this transaction
+            cursor.execute("SET LOCAL hnsw.ef_search = %s", (self.hnsw_ef_search,))
+        
+            # Build the query
+            if datasource_name:
+                cursor.execute(
+                    """
+                    SELECT id FROM datasources WHERE account_id = %s AND name = %s
+                    """,
+                    (account_id, datasource_name)
+                )
+                result = cursor.fetchone()
+                if not result:
+                    logger.warning(f"Datasource '{datasource_name}' not found for account '{account_name}'")
+                    return []
                 
-            datasource_id = result[0]
+                datasource_id = result[0]
             
-            # Query for specific datasource
-            self.pg_cursor.execute(
-                """
-                SELECT 
-                    chunk_id, document_id, parent_chunk_id, content, metadata,
-                    embedding <=> %s AS distance
-                FROM document_chunks
-                WHERE datasource_id = %s
-                ORDER BY distance ASC
-                LIMIT %s
-                """,
-                (query_embedding, datasource_id, limit)
-            )
-        else:
-            # Query across all datasources for the account
-            self.pg_cursor.execute(
-                """
-                SELECT 
-                    dc.chunk_id, dc.document_id, dc.parent_chunk_id, dc.content, dc.metadata,
-                    dc.embedding <=> %s AS distance
-                FROM document_chunks dc
-                JOIN datasources ds ON dc.datasource_id = ds.id
-                WHERE ds.account_id = %s
-                ORDER BY distance ASC
-                LIMIT %s
-                """,
-                (query_embedding, account_id, limit)
-            )
+                # Query for specific datasource
+                cursor.execute(
+                    """
+                    SELECT 
+                        chunk_id, document_id, parent_chunk_id, content, metadata,
+                        embedding <=> %s::halfvec AS distance
+                    FROM document_chunks
+                    WHERE datasource_id = %s AND embedding IS NOT NULL
+                    ORDER BY distance ASC
+                    LIMIT %s
+                    """,
+                    (query_embedding, datasource_id, limit)
+                )
+            else:
+                # Query across all datasources for the account
+                cursor.execute(
+                    """
+                    SELECT 
+                        dc.chunk_id, dc.document_id, dc.parent_chunk_id, dc.content, dc.metadata,
+                        dc.embedding <=> %s::halfvec AS distance
+                    FROM document_chunks dc
+                    JOIN datasources ds ON dc.datasource_id = ds.id
+                    WHERE ds.account_id = %s AND dc.embedding IS NOT NULL
+                    ORDER BY distance ASC
+                    LIMIT %s
+                    """,
+                    (query_embedding, account_id, limit)
+                )
         
-        results = self.pg_cursor.fetchall()
+            results = cursor.fetchall()
         
-        # Format results
-        formatted_results = []
-        for result in results:
-            formatted_results.append({
-                "id": result[0],  # chunk_id
-                "metadata": {
-                    "document_id": result[1],
-                    "parent_chunk_id": result[2],
-                    **result[4]  # metadata JSONB
-                },
-                "content": result[3],  # content
-                "distance": result[5]  # distance
-            })
+            # Format results
+            formatted_results = []
+            for result in results:
+                chunk = self._chunk_row_to_dict(result[:5])
+                chunk["distance"] = result[5]
+                formatted_results.append(chunk)
             
-        return formatted_results
+            return formatted_results
+    
+    @staticmethod
+    def _chunk_row_to_dict(row: Tuple) -> Dict[str, Any]:
+        """
+        Convert a (chunk_id, document_id, parent_chunk_id, content, metadata) row to a result dict.
+        psycopg2 already decodes the JSONB metadata to a dict, which is copied once and extended in place.
+        """
+        chunk_id, document_id, parent_chunk_id, content, metadata = row
+        chunk_metadata = dict(metadata) if metadata else {}
+        chunk_metadata['document_id'] = document_id
+        chunk_metadata['parent_chunk_id'] = parent_chunk_id
+        return {"id": chunk_id, "metadata": chunk_metadata, "content": content}
     
     def get_related_chunks(self, 
                             chunk_id: str, 
@@ -685,8 +1239,7 @@ class DocumentProcessor:
                                     account_name: str, 
                                     datasource_name: str) -> List[Dict[str, Any]]:
         """Get related chunks from Chroma DB."""
-        collection_name = f"{account_name}_{datasource_name}"
-        collection = self.chroma_client.get_or_create_collection(collection_name)
+        collection = self._get_collection(account_name)
         
         # Get the chunk
         result = collection.get(ids=[chunk_id])
@@ -729,85 +1282,22 @@ class DocumentProcessor:
                                     account_name: str, 
                                     datasource_name: str) -> List[Dict[str, Any]]:
         """Get related chunks from PostgreSQL database."""
-        # Get account and datasource IDs
-        self.pg_cursor.execute(
-            """
-            SELECT ds.id FROM datasources ds
-            JOIN accounts acc ON ds.account_id = acc.id
-            WHERE acc.name = %s AND ds.name = %s
-            """,
-            (account_name, datasource_name)
-        )
-        result = self.pg_cursor.fetchone()
-        if not result:
-            logger.warning(f"Datasource '{datasource_name}' not found for account '{account_name}'")
+        with self._pg_cursor() as cursor:
+            # Resolve the datasource and chunk, then fetch its parent and children, in one round-trip
+            self._ensure_prepared(cursor)
+            cursor.execute("EXECUTE get_related_chunks(%s, %s, %s)", (account_name, datasource_name, chunk_id))
+            results = cursor.fetchall()
+        
+        if not results:
+            logger.warning(f"No related chunks found for chunk {chunk_id} in '{account_name}/{datasource_name}'")
             return []
-            
-        datasource_id = result[0]
-        
-        # Get the chunk
-        self.pg_cursor.execute(
-            """
-            SELECT parent_chunk_id FROM document_chunks
-            WHERE datasource_id = %s AND chunk_id = %s
-            """,
-            (datasource_id, chunk_id)
-        )
-        result = self.pg_cursor.fetchone()
-        if not result:
-            logger.warning(f"Chunk {chunk_id} not found")
-            return []
-            
-        parent_chunk_id = result[0]
         
+        # Rows are ordered parent first, then children
         related_chunks = []
-        
-        # Get parent chunk
-        if parent_chunk_id:
-            self.pg_cursor.execute(
-                """
-                SELECT chunk_id, document_id, parent_chunk_id, content, metadata
-                FROM document_chunks
-                WHERE datasource_id = %s AND chunk_id = %s
-                """,
-                (datasource_id, parent_chunk_id)
-            )
-            result = self.pg_cursor.fetchone()
-            if result:
-                related_chunks.append({
-                    "id": result[0],
-                    "metadata": {
-                        "document_id": result[1],
-                        "parent_chunk_id": result[2],
-                        **result[4]
-                    },
-                    "content": result[3],
-                    "relation": "parent"
-                })
-        
-        # Get child chunks
-        self.pg_cursor.execute(
-            """
-            SELECT chunk_id, document_id, parent_chunk_id, content, metadata
-            FROM document_chunks
-            WHERE datasource_id = %s AND parent_chunk_id = %s
-            """,
-            (datasource_id, chunk_id)
-        )
-        results = self.pg_cursor.fetchall()
-        
         for result in results:
-            related_chunks.append({
-                "id": result[0],
-                "metadata": {
-                    "document_id": result[1],
-                    "parent_chunk_id": result[2],
-                    **result[4]
-                },
-                "content": result[3],
-                "relation": "child"
-            })
-            
+            chunk = self._chunk_row_to_dict(result[1:])
+            chunk["relation"] = result[0]
+            related_chunks.append(chunk)
         return related_chunks
     
     def delete_document(self, document_id: str, account_name: str, datasource_name: str) -> int:
@@ -831,19 +1321,59 @@ class DocumentProcessor:
     
     def _delete_document_chroma(self, document_id: str, account_name: str, datasource_name: str) -> int:
         """Delete a document from Chroma DB."""
-        collection_name = f"{account_name}_{datasource_name}"
-        collection = self.chroma_client.get_or_create_collection(collection_name)
+        collection = self._get_collection(account_name)
         
-        # Get all chunks for the document
-        results = collection.get(
-            where={"document_id": document_id}
-        )
+        # Delete by filter directly; the collection count before and after gives the number removed
+        # without fetching every chunk ID into Python first
+        count_before = collection.count()
+        collection.delete(where={"$and": [{"document_id": document_id}, {"datasource": datasource_name}]})
+        deleted = count_before - collection.count()
         
-        if not results or len(results["ids"]) == 0:
+        if not deleted:
             logger.warning(f"Document {document_id} not found")
-            return 0
+        return deleted
+    
+    def _delete_document_postgres(self, document_id: str, account_name: str, datasource_name: str) -> int:
+        """Delete a document from PostgreSQL database."""
+        with self._pg_cursor() as cursor:
+            # One statement resolves the datasource and removes every chunk of the document
+            cursor.execute(
+                """
+                DELETE FROM document_chunks dc
+                USING datasources ds, accounts acc
+                WHERE dc.datasource_id = ds.id AND ds.account_id = acc.id
+                    AND acc.name = %s AND ds.name = %s AND dc.document_id = %s
+                """,
+                (account_name, datasource_name, document_id)
+            )
+            deleted = cursor.rowcount
         
-        # Delete all
+        if not deleted:
+            logger.warning(f"Document {document_id} not found")
+        return deleted
+
+# File types _convert_to_markdown can process
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.pdf', '.docx', '.csv', '.txt', '.md')
+
+
+def _iter_document_files(path: str):
+    """Recursively yield processable files under path, skipping hidden entries."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_document_files(entry.path)
+            elif entry.is_file() and entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                yield entry.path
+
+
+def _write_json(section: Any) -> None:
+    """Write one section of test output to stdout as indented JSON in a single call."""
+    sys.stdout.flush()
+    sys.stdout.buffer.write(orjson.dumps(section, option=orjson.OPT_INDENT_2) + b'\n')
+    sys.stdout.buffer.flush()
+
 
 def main():
     """
@@ -888,12 +1418,8 @@ def main():
     if not args.test_dir:
         test_files = create_test_files()
     else:
-        # Gather files from provided directory
-        test_files = []
-        for root, _, files in os.walk(args.test_dir):
-            for file in files:
-                if not file.startswith('.'):  # Skip hidden files
-                    test_files.append(os.path.join(root, file))
+        # Gather processable files from provided directory
+        test_files = list(_iter_document_files(args.test_dir))
     
     # Track processed document IDs for testing search and delete
     document_ids = []
@@ -927,24 +1453,28 @@ def main():
             "This is a test file"  # Generic document content
         ]
         
+        # Collect every query's results and write them out as one JSON section
+        search_section = []
         for query in test_queries:
-            print(f"\nSearching for: '{query}'")
             results = processor.search(
                 query=query,
                 account_name=args.account,
                 datasource_name=args.datasource,
                 limit=3
             )
-            
-            if results:
-                print(f"Found {len(results)} results:")
-                for i, result in enumerate(results):
-                    print(f"\nResult {i+1} (distance: {result['distance']:.4f}):")
-                    print(f"Chunk ID: {result['id']}")
-                    print(f"Document ID: {result['metadata'].get('document_id', 'N/A')}")
-                    print(f"Content (first 100 chars): {result['content'][:100]}...")
-            else:
-                print("No results found.")
+            search_section.append({
+                "query": query,
+                "results": [
+                    {
+                        "distance": round(result['distance'], 4),
+                        "chunk_id": result['id'],
+                        "document_id": result['metadata'].get('document_id', 'N/A'),
+                        "content": result['content'][:100]
+                    }
+                    for result in results
+                ]
+            })
+        _write_json(search_section)
                 
         # Test related chunks functionality for the first search result
         if results:
@@ -956,14 +1486,10 @@ def main():
                 datasource_name=args.datasource
             )
             
-            if related:
-                print(f"Found {len(related)} related chunks:")
-                for i, chunk in enumerate(related):
-                    print(f"\nRelated Chunk {i+1} ({chunk['relation']}):")
-                    print(f"Chunk ID: {chunk['id']}")
-                    print(f"Content (first 100 chars): {chunk['content'][:100]}...")
-            else:
-                print("No related chunks found.")
+            _write_json([
+                {"relation": chunk['relation'], "chunk_id": chunk['id'], "content": chunk['content'][:100]}
+                for chunk in related
+            ])
     
     # Test delete functionality
     if args.operation in ['delete', 'all'] and document_ids:
@@ -1,9 +1,14 @@
 import asyncio
-import base64
+import binascii
+import functools
+import json
 import sys
 import platform
 import os
 import logging
+import mmap
+import threading
+import uuid
 from csv import excel
 
 if platform.system() == "Windows":
@@ -20,11 +25,12 @@ else:
 import sys
 import os
 import logging
-import shutil
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
+import aiofiles
 import markdown2
 import uvicorn
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse, HTMLResponse
 import re
 from pathlib import Path
@@ -74,6 +80,8 @@ api = FastAPI(
     description="API to upload CMA data and trigger analysis.",
     version="1.0.0"
 )
+# Report responses carry HTML and base64 charts, which compress several-fold
+api.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
 
 # --- Configuration (Centralized for API) ---
 # Consider loading from a .env file or config management system
@@ -101,6 +109,23 @@ API_CONFIG["UPLOAD_DIR"].mkdir(parents=True, exist_ok=True)
 API_CONFIG["OUTPUT_DIR"].mkdir(parents=True, exist_ok=True)
 
 timestamp_pattern = re.compile(r'_\d{8}_\d{6}\.md$')
+# Runs of characters other than alphanumerics, underscore and hyphen
+unsafe_chars_pattern = re.compile(r'[^\w\-]+')
+
+# Uploads are written to disk in 1 MiB reads instead of shutil's 16 KiB default
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Caps how many sheet reports are rendered at once, bounding worker threads and open files per request burst
+REPORT_RENDER_CONCURRENCY = asyncio.Semaphore(8)
+
+# Charts larger than this are memory-mapped for encoding rather than read into a bytes object
+MMAP_MIN_SIZE = 64 * 1024
+
+# Analysis runs in the background; running jobs live here, finished ones as JSON files in JOBS_DIR
+JOBS: Dict[str, asyncio.Task] = {}
+JOBS_DIR = API_CONFIG["OUTPUT_DIR"] / "jobs"
+JOBS_DIR.mkdir(parents=True, exist_ok=True)
+job_id_pattern = re.compile(r'[0-9a-f]{32}')
 
 # --- Helper Functions ---
 def sanitize_input(input_string: str) -> str:
@@ -108,15 +133,100 @@ def sanitize_input(input_string: str) -> str:
     if not input_string:
         return ""
     # Remove potentially harmful chars, allow alphanumeric, underscore, hyphen
-    sanitized = re.sub(r'[^\w\-]+', '_', input_string)
+    sanitized = unsafe_chars_pattern.sub('_', input_string)
     # Limit length
     return sanitized[:100].lower()
 
 
-def get_analysis_reports(account_name: str):
+# markdown2.Markdown instances keep per-conversion state, so each worker thread reuses its own
+_markdown_local = threading.local()
+
+
+def _markdown_converter() -> markdown2.Markdown:
+    """Return this thread's Markdown converter, creating it on first use."""
+    converter = getattr(_markdown_local, "converter", None)
+    if converter is None:
+        converter = _markdown_local.converter = markdown2.Markdown(extras=["tables", "fenced-code-blocks"])
+    return converter
+
+
+# Rendered reports and encoded charts are cached by (path, mtime_ns, size), so an edited file misses automatically
+@functools.lru_cache(maxsize=256)
+def _render_md(path_str: str, mtime_ns: int, size: int) -> str:
+    """Read a Markdown report and convert it to HTML."""
+    with open(path_str, 'r', encoding=API_CONFIG["ANALYZER_CONFIG"]["file_encoding"]) as f:
+        return _markdown_converter().convert(f.read())
+
+
+@functools.lru_cache(maxsize=256)
+def _encode_svg(path_str: str, mtime_ns: int, size: int) -> str:
+    """Read an SVG chart and base64-encode it; large charts are memory-mapped to skip the read copy."""
+    with open(path_str, 'rb') as graph:
+        if size > MMAP_MIN_SIZE:
+            with mmap.mmap(graph.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return binascii.b2a_base64(mm, newline=False).decode('ascii')
+        return binascii.b2a_base64(graph.read(), newline=False).decode('ascii')
+
+
+async def _cached_file(render, path: Path) -> str:
+    """Run a cached file helper off the event loop, keyed on the file's current stat."""
+    st = path.stat()
+    return await asyncio.to_thread(render, str(path), st.st_mtime_ns, st.st_size)
+
+
+async def _read_svg(path: Path) -> Tuple[str, str]:
+    """Return a chart's filename with its base64-encoded SVG."""
+    return path.name, await _cached_file(_encode_svg, path)
+
+
+def _report_name(report_path: Path) -> str:
+    """Extract sheet name from filename (e.g., balance_sheet_report_timestamp.md -> Balance Sheet)."""
+    return report_path.stem.split('.')[0].replace('_', ' ').title()
+
+
+async def _load_individual_report(report_path: Path, graph_dir: Path) -> Dict[str, Any]:
+    """Load one sheet report with its charts, reading the charts concurrently."""
+    async with REPORT_RENDER_CONCURRENCY:
+        return await _render_individual_report(report_path, graph_dir)
+
+
+async def _render_individual_report(report_path: Path, graph_dir: Path) -> Dict[str, Any]:
+    """Render one sheet report and its charts."""
+    base_name = report_path.stem.split('.')[0]
+    report_name = _report_name(report_path)
+    content_html = await _cached_file(_render_md, report_path)
+
+    charts_per_sheet = []
+    graphs_sheets_dir = graph_dir / base_name
+    if graphs_sheets_dir.is_dir():
+        # One directory scan; is_file() uses the entry's cached type instead of another stat
+        with os.scandir(graphs_sheets_dir) as entries:
+            svg_paths = [Path(entry.path) for entry in entries if entry.name.endswith(".svg") and entry.is_file()]
+        charts_per_sheet = dict(await asyncio.gather(*(_read_svg(svg_path) for svg_path in svg_paths)))
+
+    return {
+        'report_name': report_name,
+        'content': content_html,
+        'type': 'individual',
+        'charts': charts_per_sheet
+    }
+
+
+async def _load_cumulative_report(cumulative_path: Path) -> Dict[str, Any]:
+    """Load the cumulative report."""
+    return {
+        'report_name': "Cumulative Report",
+        'content': await _cached_file(_render_md, cumulative_path),
+        'type': 'cumulative',
+        'charts': {}
+    }
+
+
+async def get_analysis_reports(account_name: str):
     """
     Retrieve analysis reports (individual sheets + cumulative)
     for a specific account. Converts Markdown to HTML.
+    All reports and charts are read concurrently.
     """
     safe_account = sanitize_input(account_name)
 
@@ -127,87 +237,107 @@ def get_analysis_reports(account_name: str):
 
     reports_dir = account_output_dir / API_CONFIG["ANALYZER_CONFIG"]["reports_dir"]
     graph_dir = account_output_dir / API_CONFIG["ANALYZER_CONFIG"]["graph_dir"]
-    individual_report_pattern = "*.md"
 
-    report_files_content = []
-
-    # Get individual reports
+    # Collect the report paths first, then load them all at once
+    # Filter on the scandir entry (cached type, no stat) so skipped files never become Path objects;
+    # timestamped files are archived copies of earlier runs
+    report_paths = []
     if reports_dir.is_dir():
-        for report_path in reports_dir.glob(individual_report_pattern):
-            if not report_path.is_file():
-                continue
-
-            filename = report_path.name
-            # *** FILTERING STEP ***
-            if timestamp_pattern.search(filename):
-                print(filename)
-                logger.debug(f"Ignoring timestamped file: {filename}")
-                continue  # Skip this file
-
-            try:
-                charts_per_sheet=[]
-                # Extract sheet name from filename (e.g., balance_sheet_report_timestamp.md -> Balance Sheet)
-                base_name = report_path.stem.split('.')[0]
-                report_name = base_name.replace('_', ' ').title()
-                with open(report_path, 'r', encoding=API_CONFIG["ANALYZER_CONFIG"]["file_encoding"]) as f:
-                    content_md = f.read()
-                    content_html = markdown2.markdown(content_md, extras=["tables", "fenced-code-blocks"])
-                if base_name in os.listdir(graph_dir):
-                    individual_graph_pattern = "*.svg"
-                    graphs_sheets_dir = graph_dir/base_name
-                    charts_per_sheet = {}
-                    for graphs in graphs_sheets_dir.glob(individual_graph_pattern):
-                        if not graphs.is_file():
-                            continue
-                        graph_filename = graphs.name
-                        print(graph_filename)
-                        with open(graphs, 'rb') as graph:
-                            graph_content= graph.read()
-                            svg_content_base64 = base64.b64encode(graph_content).decode('utf-8')
-                            # print(svg_content_base64)
-                            charts_per_sheet[graph_filename] = svg_content_base64
-
-                report_files_content.append({
-                    'report_name': report_name,
-                    'content': content_html,
-                    'type': 'individual',
-                    'charts':charts_per_sheet
-                })
-            except Exception as e:
-                logger.error(f"Error reading or processing report {report_path}: {e}")
-
-    cumulative_path = os.path.join(account_output_dir,"Cumulative_Report.md")
-
-    if not os.path.exists(cumulative_path):
-        file_content = []
-    else:
-        try:
-            with open(cumulative_path, 'r', encoding=API_CONFIG["ANALYZER_CONFIG"]["file_encoding"]) as file:
-                content_md = file.read()
-                content_html = markdown2.markdown(content_md, extras=["tables", "fenced-code-blocks"])
-                report_files_content.append({
-                     'report_name': "Cumulative Report",
-                     'content': content_html,
-                     'type': 'cumulative',
-                     'charts': {}
-                })
-        except Exception as e:
-             logger.error(f"Error reading or processing cumulative report {cumulative_path}: {e}")
-             # Optionally add a placeholder if needed
-         # report_files_content.append({'report_name': "Cumulative Report", 'content': '<p>Not generated or found.</p>', 'type': 'cumulative'})
+        with os.scandir(reports_dir) as entries:
+            report_paths = [Path(entry.path) for entry in entries
+                            if entry.name.endswith(".md") and not timestamp_pattern.search(entry.name) and entry.is_file()]
+    # Order reports up front (cumulative first, then by report name); gather keeps that order
+    report_paths.sort(key=_report_name)
 
+    loaders = [_load_individual_report(report_path, graph_dir) for report_path in report_paths]
+
+    cumulative_path = account_output_dir / "Cumulative_Report.md"
+    if cumulative_path.is_file():
+        report_paths.insert(0, cumulative_path)
+        loaders.insert(0, _load_cumulative_report(cumulative_path))
+
+    report_files_content = []
+    for report_path, result in zip(report_paths, await asyncio.gather(*loaders, return_exceptions=True)):
+        if isinstance(result, Exception):
+            logger.error(f"Error reading or processing report {report_path}: {result}")
+            continue
+        report_files_content.append(result)
 
     if not report_files_content:
         raise HTTPException(status_code=404, detail=f"No valid reports found in the latest run for account: {account_name}")
 
-    # Sort reports (e.g., cumulative last)
-    report_files_content.sort(key=lambda x: (x['type'] != 'cumulative', x['report_name']))
-
+    # Already ordered: cumulative first, then individual reports by name
     return report_files_content
 
 
+async def _run_analysis_job(job_id: str, safe_account: str, **task_kwargs) -> Dict[str, Any]:
+    """Run one analysis in the background and persist its outcome so it survives restarts."""
+    try:
+        final_state = await run_cma_analysis_task(account_name=safe_account, **task_kwargs)
+        logger.info(f"Analysis task finished for account: {safe_account}")
+
+        # Check final state for errors logged during the run
+        run_errors = final_state.get("error_logs", []) if final_state else ["Task did not return state."]
+        if run_errors:
+            logger.warning(f"Analysis for {safe_account} completed with errors: {run_errors}")
+            result = {
+                "status": "success",
+                "message": f"Analysis completed for {safe_account}, but some errors occurred during processing. Check server logs.",
+                "run_errors": run_errors
+            }
+        else:
+            result = {
+                "status": "success",
+                "message": f"Analysis successfully completed for {safe_account}."
+            }
+    except Exception as e:
+        # Catch errors raised from the analysis task itself
+        logger.error(f"Analysis task execution failed for {safe_account}: {e}", exc_info=True)
+        result = {"status": "failed", "message": f"Analysis workflow failed: {str(e)}"}
+
+    result["job_id"] = job_id
+    try:
+        async with aiofiles.open(JOBS_DIR / f"{job_id}.json", "w", encoding="utf-8") as f:
+            await f.write(json.dumps(result, default=str))
+    except OSError as e:
+        logger.error(f"Could not persist result of job {job_id}: {e}")
+    return result
+
+
 # --- API Endpoints ---
 
+# Result of the startup subprocess check; the analysis workflow spawns the MCP server as a subprocess
+SUBPROCESS_OK = False
+
+
+@api.on_event("startup")
+async def _subprocess_check():
+    """Check once per process that asyncio can spawn subprocesses under the current event loop."""
+    global SUBPROCESS_OK
+    logger.info("--- Attempting simplified subprocess test ---")
+    command = sys.executable
+    try:
+        process = await asyncio.create_subprocess_exec(
+            command, "--version",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        logger.info(f"Simplified test subprocess exited with code: {process.returncode}")
+        if stdout: logger.info(f"Simplified test STDOUT: {stdout.decode().strip()}")
+        if stderr: logger.warning(f"Simplified test STDERR: {stderr.decode().strip()}")
+        SUBPROCESS_OK = process.returncode == 0
+    except NotImplementedError as nie:
+        logger.error(f"!!! Simplified subprocess test FAILED with NotImplementedError: {nie}", exc_info=True)
+    except FileNotFoundError as fnf_err:
+        logger.error(f"!!! Simplified subprocess test FAILED - Command not found: {command} - {fnf_err}", exc_info=True)
+    except Exception as test_err:
+        logger.error(f"!!! Simplified subprocess test FAILED with other error: {test_err}", exc_info=True)
+
+    if SUBPROCESS_OK:
+        logger.info("--- Simplified subprocess test successful ---")
+    else:
+        logger.error("--- Simplified subprocess test failed; /analyze will reject requests ---")
+
 
 
 @api.post("/analyze", tags=["Analysis"])
@@ -233,40 +363,10 @@ async def trigger_analysis(
         logger.error(f"Error getting loop/policy info: {log_err}")
     # --- End logging ---
 
-    # +++ Simplified Subprocess Test +++
-    logger.info("--- Attempting simplified subprocess test ---")
-    try:
-        command = sys.executable
-        args = ["--version"]
-        logger.info(f"Running command: {command} {' '.join(args)}")
-
-        process = await asyncio.create_subprocess_exec(
-            command, *args,
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        logger.info(f"Simplified test subprocess created with PID: {process.pid}")
-        stdout, stderr = await process.communicate()
-        logger.info(f"Simplified test subprocess exited with code: {process.returncode}")
-        if stdout: logger.info(f"Simplified test STDOUT: {stdout.decode().strip()}")
-        if stderr: logger.warning(f"Simplified test STDERR: {stderr.decode().strip()}")
-
-        if process.returncode == 0:
-            logger.info("--- Simplified subprocess test successful ---")
-        else:
-            logger.error("--- Simplified subprocess test failed (non-zero exit code) ---")
-            raise HTTPException(status_code=500, detail="Server configuration error: Subprocess test failed.")
-
-    except NotImplementedError as nie:
-        logger.error(f"!!! Simplified subprocess test FAILED with NotImplementedError: {nie}", exc_info=True)
+    # The subprocess check runs once at startup
+    if not SUBPROCESS_OK:
         raise HTTPException(status_code=500,
-                            detail="Server configuration error: asyncio subprocess execution not supported.")
-    except FileNotFoundError as fnf_err:
-        logger.error(f"!!! Simplified subprocess test FAILED - Command not found: {command} - {fnf_err}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Server configuration error: Python executable not found for test.")
-    except Exception as test_err:
-        logger.error(f"!!! Simplified subprocess test FAILED with other error: {test_err}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Server error during internal test: {test_err}")
-    # +++ End Simplified Subprocess Test +++
+                            detail="Server configuration error: asyncio subprocess execution failed at startup.")
 
     safe_account = sanitize_input(account_name)
     print(safe_account)
@@ -280,10 +380,10 @@ async def trigger_analysis(
     try:
         account_dir = Path(API_CONFIG["UPLOAD_DIR"] / account_name)
         account_dir.mkdir(parents=True, exist_ok=True)
-        file_path = os.path.join(account_dir, file.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            excel_file_path = buffer.name # Get the path to the temporary file
+        excel_file_path = os.path.join(account_dir, file.filename)
+        async with aiofiles.open(excel_file_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
         logger.info(f"File uploaded temporarily to: {excel_file_path} for account: {safe_account}")
 
         # --- Prepare paths and config for the analysis task ---
@@ -295,40 +395,27 @@ async def trigger_analysis(
 
         output_base_dir = str(API_CONFIG["OUTPUT_DIR"]) # Base directory for all account outputs
 
-        # --- Call the async analysis task ---
-        logger.info(f"Triggering analysis task for account: {safe_account}")
-        try:
-            # Pass the app_logger instance to the task
-            final_state = await run_cma_analysis_task(
-                account_name=safe_account,
-                excel_file_path=excel_file_path,
-                output_base_dir=output_base_dir,
-                mcp_server_path=mcp_server_path,
-                config=API_CONFIG["ANALYZER_CONFIG"],
-                logger=app_logger # Pass the specific logger
-            )
-            logger.info(f"Analysis task finished for account: {safe_account}")
-
-            # Check final state for errors logged during the run
-            run_errors = final_state.get("error_logs", []) if final_state else ["Task did not return state."]
-            if run_errors:
-                 logger.warning(f"Analysis for {safe_account} completed with errors: {run_errors}")
-                 # Return success but indicate errors occurred
-                 return JSONResponse(content={
-                     "status": "success",
-                     "message": f"Analysis completed for {safe_account}, but some errors occurred during processing. Check server logs.",
-                     "run_errors": run_errors
-                 })
-            else:
-                 return JSONResponse(content={
-                     "status": "success",
-                     "message": f"Analysis successfully completed for {safe_account}."
-                 })
-
-        except Exception as e:
-            # Catch errors raised from the analysis task itself
-            logger.error(f"Analysis task execution failed for {safe_account}: {e}", exc_info=True)
-            raise HTTPException(status_code=500, detail=f"Analysis workflow failed: {str(e)}")
+        # --- Start the analysis task in the background ---
+        job_id = uuid.uuid4().hex
+        logger.info(f"Starting analysis job {job_id} for account: {safe_account}")
+        task = asyncio.create_task(_run_analysis_job(
+            job_id,
+            safe_account,
+            excel_file_path=excel_file_path,
+            output_base_dir=output_base_dir,
+            mcp_server_path=mcp_server_path,
+            config=API_CONFIG["ANALYZER_CONFIG"],
+            logger=app_logger # Pass the specific logger
+        ))
+        JOBS[job_id] = task
+        # The job's result is on disk by the time the task completes
+        task.add_done_callback(lambda _: JOBS.pop(job_id, None))
+
+        return JSONResponse(status_code=202, content={
+            "status": "accepted",
+            "job_id": job_id,
+            "message": f"Analysis started for {safe_account}. Poll /jobs/{job_id} for the result."
+        })
 
     except HTTPException:
         raise # Re-raise HTTP exceptions directly
@@ -340,6 +427,23 @@ async def trigger_analysis(
              file.file.close()
 
 
+@api.get("/jobs/{job_id}", tags=["Analysis"])
+async def get_job_status(job_id: str):
+    """Returns the status of an analysis job, or its result once finished."""
+    if not job_id_pattern.fullmatch(job_id):
+        raise HTTPException(status_code=400, detail="Invalid job id.")
+
+    task = JOBS.get(job_id)
+    if task is not None and not task.done():
+        return {"status": "running", "job_id": job_id}
+
+    job_path = JOBS_DIR / f"{job_id}.json"
+    if not job_path.is_file():
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    async with aiofiles.open(job_path, "r", encoding="utf-8") as f:
+        return json.loads(await f.read())
+
+
 @api.get("/reports/{account_name}", tags=["Reports"],response_model=List[Dict[str, Any]])
 async def retrieve_reports(account_name: str):
     """
@@ -348,7 +452,7 @@ async def retrieve_reports(account_name: str):
     """
     logger.info("Retrival API called")
     try:
-        reports = get_analysis_reports(account_name)
+        reports = await get_analysis_reports(account_name)
         return reports
     except HTTPException:
         raise # Let FastAPI handle HTTP exceptions
@@ -1,33 +1,232 @@
+import functools
+import importlib.util
+import math
 import os
+import re
+from pathlib import Path
 from textwrap import dedent
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 
 from dotenv import load_dotenv, find_dotenv
 import pandas as pd
 from typing_extensions import TypedDict
 
 from langgraph.graph import StateGraph
+from langchain_community.cache import SQLiteCache
+from langchain_core.globals import set_llm_cache
 from langchain_openai import AzureChatOpenAI
 from langchain_ollama import ChatOllama
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG,  # Set the desired logging level
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load environment variables
-load_dotenv(find_dotenv(), verbose=True, override=True)
+# Load environment variables; values already set in the process environment take precedence over .env
+load_dotenv(find_dotenv())
+
+# Aliases read by the LLM clients; only set for variables that are actually defined
+for _alias, _source in (("AZURE_API_KEY", "AZURE_OPENAI_API_KEY"), ("AZURE_API_VERSION", "AZURE_OPENAI_API_VERSION")):
+    if os.getenv(_source):
+        os.environ[_alias] = os.environ[_source]
+
+# Appended to the system message when several sheets share one LLM call
+MARSHALED_SHEETS_INSTRUCTIONS = dedent("""
+    The user message contains several sheets, each between '=== SHEET: <name> ===' and '=== END ===' lines,
+    with its own analysis instructions followed by its data. Analyze every sheet separately following its
+    instructions. Respond with only a JSON object mapping each sheet name, exactly as given, to its analysis
+    as a Markdown string.
+""")
+
+# Used when a sheet is too large for one call: each part is analyzed alone, then the parts are combined
+SHEET_PART_INSTRUCTIONS = dedent("""
+    The user message holds part {part} of {parts} of this sheet's rows. Analyze only these rows; the partial
+    analyses are combined afterwards.
+""")
+COMBINE_PARTS_INSTRUCTIONS = dedent("""
+    The user message holds analyses of consecutive parts of the same sheet, in order. Combine them into a single
+    analysis following the instructions above, without referring to the parts.
+""")
+
+# Sheets sent for analysis, matched on the name without its numeric suffix ("Fund Flow2" -> "Fund Flow")
+ANALYZED_SHEETS = {"Fund Flow"}
+_DIGIT_SUFFIX = re.compile(r'\d+$')
+
+
+# Analysis instructions for the known CMA sheet types; built once at import
+SHEET_PROMPTS = {
+    "Profit & Loss Statement": dedent("""Analyze this Profit & Loss Statement data and provide key insights:
+
+    Key metrics that should be monitored in a Profit and Loss (P&L) Statement :
+        1. Revenue/Sales: Assess total revenue, breaking it down by product lines or business segments. Consider growth trends and seasonal variations.
+        2. Cost of Goods Sold (COGS): Analyze direct production costs. Discuss efficiency in managing production costs and its impact on profit margins. 
+        3. Calculate and assess gross profit margin: Gross Profit Margin = (Gross Profit / Revenue), which helps to metric reveals how well the company is managing its production costs relative to its sales.
+        4. Operating Expenses: Review operating expenses, including SG&A, R&D, and marketing. Assess the balance in spending.
+        5. Operating Income (EBIT): Analyze operating income (Earnings Before Interest and Taxes) and its trend. Determine operational efficiency excluding interest and taxes.
+        6. Operating Profit Margin: Calculate operating profit margin: Operating Profit Margin = (EBIT/Revenue)
+        7. Net Income: Review net income (bottom line) reflecting total profitability after all expenses. Assess overall financial health.
+        8. Net Profit Margin: Calculate net profit margin:  Net Profit Margin = (Net Income / Revenue)
+        9. Earnings Per Share (EPS): If applicable, analyze EPS to evaluate profit per outstanding share. Compare EPS trends over time.
+        10. EBITDA: Evaluate Earnings Before Interest, Taxes, Depreciation, and Amortization as a measure of operational performance and cash flow generation.
+        11. Depreciation and Amortization: Examine the impact of depreciation and amortization on net income, especially for capital-intensive companies.
+        12. Interest Expense: Review the cost of debt and its effect on profitability. High interest expenses may indicate over-leverage.
+        13. Tax Expense: Assess tax liability and its impact on net income. Look for changes in tax rates or strategies.
+        14. EBIT to EBITDA Conversion: Understand the relationship between EBIT and EBITDA and how non-cash expenses (depreciation, amortization) affect profitability.
+    """),
+
+    "Balance Sheet": dedent("""
+    Analyze this Balance Sheet to assess the financial health and stability of a company. Focus on key financial metrics, including liquidity, solvency, profitability, 
+    and efficiency. Examine trends in assets, liabilities, and equity to evaluate the company’s leverage, working capital, and overall financial position. Identify any 
+    risks or red flags, such as liquidity shortages, excessive debt, or declining asset value. Provide insights into how these financial metrics align with business 
+    performance and long-term sustainability. 
+
+    Key Metrics to Monitor in Balance Sheet Analysis:
+
+    - Liquidity Ratios (Short-term Financial Health):
+         -- Current Ratio: Current Assets / Current Liabilities. Measures the ability to cover short-term obligations.
+         -- Quick Ratio (Acid-Test Ratio): (Current Assets - Inventory) / Current Liabilities. A more stringent liquidity measure.
+         -- Working Capital: Current Assets - Current Liabilities. Indicates operational liquidity.
+    - Solvency Ratios (Long-term Financial Stability):
+         -- Debt-to-Equity Ratio: Total Debt / Total Equity. Measures financial leverage.
+         -- Interest Coverage Ratio: EBIT / Interest Expense. Ability to service debt.
+    - Asset Management & Efficiency Ratios:
+         -- Return on Assets (ROA): Net Income / Total Assets. Efficiency in using assets to generate profit.
+         -- Fixed Asset Turnover: Revenue / Fixed Assets. Effectiveness in utilizing fixed assets.
+    - Profitability Indicators:
+         -- Return on Equity (ROE): Net Income / Shareholder’s Equity. Profitability from shareholder investment.
+         -- Gross Profit Margin: (Revenue - COGS) / Revenue. Measures core business profitability.
+    - Capital Structure & Leverage Analysis:
+         -- Equity Ratio: Shareholder’s Equity / Total Assets. Indicates the proportion of assets financed by equity.
+         -- Debt Ratio: Total Debt / Total Assets. Shows the percentage of assets financed by debt.
+    - Cash & Reserves Analysis:       
+         -- Cash and Cash Equivalents: Assess liquidity reserves.
+         -- Retained Earnings: Evaluate profit reinvestment for growth.
+    """),
+
+    "Fund Flow": dedent("""
+    Analyze the key metrics that should be monitored in a Fund Flow Statement. The goal is to identify the most relevant 
+    financial metrics and ratios that provide insights into the movement of funds within a business or organization. 
+    Focus on the major inflows and outflows, their sources, and how they impact cash liquidity, profitability, and the 
+    company's financial health.
+
+    Be sure to discuss the following:
+
+    1. Net Cash Flow: Determine whether the company has a positive or negative net cash flow and the implications of this for the business.
+    2. Operating Cash Flow: Analyze cash generated or used by the company's core operating activities. Consider whether the company is effectively converting its income into cash.
+    3. Investing Cash Flow: Identify significant capital expenditures or investments in assets, as well as proceeds from asset sales.
+    4. Financing Cash Flow: Evaluate cash movements from activities like issuing or repaying debt, issuing equity, or paying dividends.
+    5. Liquidity Position: Assess the company's liquidity based on available cash and equivalents, and how this affects its ability to meet short-term obligations.
+    6. Working Capital: Review changes in working capital, such as increases or decreases in accounts receivable, inventory, and accounts payable, and their impact on cash flow.
+    7. Free Cash Flow: Calculate and analyze the company’s ability to generate cash after capital expenditures.
+    8. Debt Service: Review the company’s ability to meet its debt obligations, including principal and interest payments.
+    9. Cash Flow from Operations to Net Income: Compare operating cash flow to net income, checking for discrepancies that might suggest non-cash adjustments.
+
+Fund Flow Statement Analysis Template
+1. Introduction 
+    - Brief overview of the company's financial position. 
+    - Purpose of the Fund Flow Statement analysis. 
+    - Key observations on fund movements.
+2. Sources of Funds 
+    (List out major sources of funds and their impact) 
+    Source | Amount ($) | Remarks
+    Net Profit (After Tax) | XXX | Indicates earnings available for reinvestment.
+    Depreciation & Amortization| XXX | Non-cash expense added back as a source of funds.
+    Sale of Fixed Assets | XXX | Liquidation of assets generating cash inflow.
+    Issuance of Shares | XXX | Equity capital raised from investors.
+    Loan Borrowings | XXX | New debt raised for business expansion.
+    Other Inflows | XXX | Miscellaneous sources of funds.
+3. Application (Uses) of Funds 
+   (List out major uses of funds and their impact) 
+    | **Use**                        | **Amount ($)** | **Remarks**                                      |
+    |--------------------------------|----------------|--------------------------------------------------|
+    | Capital Expenditures           | XXX            | Investment in new assets, expansion projects.    |
+    | Loan Repayment                 | XXX            | Debt reduction, improves solvency.               |
+    | Dividend Payments              | XXX            | Returns given to shareholders.                   |
+    | Increase in Working Capital    | XXX            | Indicates operational fund usage.                |
+    | Purchase of Investments        | XXX            | Investment or strategic acquisitions.            |
+    | Other Outflows                 | XXX            | Miscellaneous fund applications.                 |
+4. Changes in Working Capital 
+    Increase in Current Assets (e.g., Inventory, Accounts Receivable) → Uses of funds. 
+    Increase in Current Liabilities (e.g., Payables, Short-term Debt) → Sources of funds. 
+    Net Change in Working Capital: Positive or negative impact on liquidity.
+5. Fund Flow from Different Activities
+    | **Activity Type**        | **Net Inflow/Outflow ($)** | **Remarks**                                |
+    |--------------------------|----------------------------|--------------------------------------------|
+    | Operating Activities     | XXX                        | Profitability and core business cash flow. |
+    | Investing Activities     | XXX                        | Asset purchases/sales impact.              |
+    | Financing Activities     | XXX                        | Debt and equity transactions.              |
+6. Liquidity & Financial Stability Assessment 
+    Cash Flow Sufficiency: Can the company meet short-term and long-term obligations? 
+    Debt-Equity Ratio Impact: Does fund movement improve or worsen financial leverage? 
+    Overall Business Strategy Alignment: Are fund flows supporting business growth? 
+7. Key Insights & Recommendations 
+    Identify positive trends (e.g., strong cash inflows, reduced debt, improved working capital). 
+    Highlight risk factors (e.g., declining liquidity, excessive debt, negative working capital). 
+    Suggest strategic actions to optimize fund management
+    """),
+}
+
+# Fallback for other sheets, filled in with str.format(sheet_name=..., data_str=...)
+DEFAULT_SHEET_PROMPT = """
+Analyze this financial data from the '{sheet_name}' sheet and provide key insights:
+
+{data_str}
+
+Please include:
+1. Key trends and patterns
+2. Notable anomalies or concerns
+3. Actionable recommendations
+4. Important metrics to monitor
+5. Overall assessment
+"""
+
+
+@functools.lru_cache(maxsize=1)
+def _default_llm():
+    """Builds the default Azure OpenAI client once per process so its HTTP connection pool is reused."""
+    return AzureChatOpenAI(
+        model="gpt-4o-mini",
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+        api_version=os.getenv("AZURE_API_VERSION"),
+        temperature=0
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _excel_engine() -> str:
+    """Returns 'calamine' when python-calamine is installed and pandas supports it (2.2+), else 'openpyxl'."""
+    pandas_version = tuple(int(part) for part in pd.__version__.split(".")[:2])
+    if pandas_version >= (2, 2) and importlib.util.find_spec("python_calamine") is not None:
+        return "calamine"
+    return "openpyxl"
+
+
+def _cell_text(value) -> str:
+    """Formats a cell compactly for the LLM: whole floats lose their '.0' and pandas' 'Unnamed: N' labels are blanked."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    text = str(value)
+    return "" if text.startswith("Unnamed:") else text
+
+
+def _to_md(columns, rows) -> str:
+    """
+    Renders a header and rows of cell values as a Markdown table, without tabulate's column-width padding.
 
-# Load environment variables
-load_dotenv()
+    Args:
+        columns: The column labels.
+        rows: The row values, e.g. a 2-D object array.
 
-os.environ["AZURE_API_KEY"] = os.getenv("AZURE_OPENAI_API_KEY")
-os.environ["AZURE_ENDPOINT"] = os.getenv("AZURE_ENDPOINT")
-os.environ["AZURE_API_VERSION"] = os.getenv("AZURE_OPENAI_API_VERSION")
-os.environ["GEMINI_API_KEY"] = os.getenv("GEMINI_API_KEY")
+    Returns:
+        str: The Markdown table.
+    """
+    lines = ["| " + " | ".join(map(_cell_text, columns)) + " |", "|" + "---|" * len(columns)]
+    lines.extend("| " + " | ".join(map(_cell_text, row)) + " |" for row in rows)
+    return "\n".join(lines)
 
 
 class CMAAnalysisState(TypedDict):
@@ -43,22 +242,45 @@ class CMAAnalyzer:
     A class for analyzing CMA data from Excel files using LLMs.
     """
 
-    def __init__(self, llm=None, output_path="../data/output/walmart/reports"):
+    def __init__(self, llm=None, output_path="../data/output/walmart/reports", max_concurrency=8, sheets_per_call=1,
+                 llm_cache_path=".cma_llm_cache.sqlite", sheet_token_budget=100_000):
         """
         Initializes the CMAAnalyzer with an LLM and output path.
 
         Args:
             llm: The language model to use for analysis. Defaults to AzureChatOpenAI.
             output_path (str): The directory to save the output Markdown files.
+            max_concurrency (int): Maximum number of sheet analyses in flight at once.
+            sheets_per_call (int): Sheets combined into one LLM call (1 disables combining; 2-4 suits small sheets).
+            llm_cache_path (str): SQLite file caching LLM responses by prompt and model settings; None disables it.
+            sheet_token_budget (int): Largest sheet sent in one call; bigger sheets are analyzed in parts and combined.
         """
-        self.llm = llm or AzureChatOpenAI(
-            model="gpt-4o-mini",
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            azure_endpoint=os.getenv("AZURE_ENDPOINT"),
-            api_version=os.getenv("AZURE_API_VERSION"),
-            temperature=0
-        )
+        self.llm = llm or _default_llm()
         self.output_parser = StrOutputParser()
+        self.max_concurrency = max_concurrency
+        self.sheets_per_call = sheets_per_call
+        self.sheet_token_budget = sheet_token_budget
+        self._token_encoding = None  # tiktoken encoding, loaded on first use
+        self._app = None  # compiled LangGraph workflow, built on first run and reused for later files
+        # One chain serves every sheet; the sheet prompt and data are passed in as variables
+        self.sheet_chain = (
+                ChatPromptTemplate.from_messages([
+                    ("system", "{system}"),
+                    ("human", "{data}")
+                ])
+                # Retry rate-limit and network failures with exponential backoff
+                | self.llm.with_retry(stop_after_attempt=3, wait_exponential_jitter=True)
+                | self.output_parser
+        )
+        # Several sheets in one call, answered as a {sheet_name: analysis_md} JSON object
+        self.marshaled_chain = (
+                ChatPromptTemplate.from_messages([
+                    ("system", "{system}"),
+                    ("human", "{data}")
+                ])
+                | self.llm.with_retry(stop_after_attempt=3, wait_exponential_jitter=True)
+                | JsonOutputParser()
+        )
         self.output_path = output_path
         self.system_message = "You are a financial analyst, expert in analyzing CMA data."
 
@@ -66,6 +288,12 @@ class CMAAnalyzer:
         os.makedirs(self.output_path, exist_ok=True)
         logging.info(f"Output directory set to: {self.output_path}")
 
+        # Reruns on unchanged sheets are answered from disk. Entries are keyed by the full prompt (system
+        # message and sheet data) plus the model's parameters, so changed data or settings miss the cache.
+        if llm_cache_path:
+            set_llm_cache(SQLiteCache(database_path=llm_cache_path))
+            logging.info(f"LLM response cache: {llm_cache_path}")
+
     def extract_text_from_excel(self, state: Dict[str, Any]) -> Dict[str, Any]:
         """
         Extracts data from Excel sheets and converts them to Markdown format.
@@ -74,46 +302,62 @@ class CMAAnalyzer:
             state (Dict[str, Any]): The current state of the analysis, including the Excel file path.
 
         Returns:
-            Dict[str, Any]: The updated state with the extracted sheet data.
+            Dict[str, Any]: The updated state with the paths of the extracted sheet Markdown files.
         """
         logging.info("Starting extract_text_from_excel")
         excel_file_path = state["excel_file_path"]
         logging.debug(f"Excel file path: {excel_file_path}")
 
         try:
-            xl = pd.ExcelFile(excel_file_path)
-            sheet_names = xl.sheet_names
-            logging.debug(f"Sheet names: {sheet_names}")
-            sheets_data = {}
+            # calamine (Rust) is the fastest values-only reader; without it, openpyxl's read-only mode
+            # streams rows instead of loading every cell object
+            engine = _excel_engine()
+            logging.debug(f"Excel engine: {engine}")
+            engine_kwargs = {'read_only': True} if engine == 'openpyxl' else None
+            # Either engine keeps the file open until the ExcelFile is closed
+            with pd.ExcelFile(excel_file_path, engine=engine, engine_kwargs=engine_kwargs) as xl:
+                sheet_names = xl.sheet_names
+                logging.debug(f"Sheet names: {sheet_names}")
+
+                # Pick the wanted sheets before parsing so the rest of the workbook is never read
+                base_names = {sheet: _DIGIT_SUFFIX.sub('', sheet) for sheet in sheet_names}
+                target = [sheet for sheet in sheet_names if base_names[sheet] in ANALYZED_SHEETS]
+                logging.debug(f"Sheets to extract: {target}")
+
+                # One parse call for every wanted sheet; pandas returns {sheet_name: DataFrame}
+                frames = xl.parse(sheet_name=target) if target else {}
 
-            if len(sheet_names) > 0:
-                for sheet in sheet_names:
-                    logging.debug(f"Processing sheet: {sheet}")
-                    if sheet in ["Fund Flow", "Fund Flow2"]:
-                        try:
-                            df = pd.read_excel(excel_file_path, engine='openpyxl', sheet_name=sheet)
-                            df_cleaned = df.dropna(how='all')
-                            df2 = df_cleaned.fillna('').reset_index(drop=True)
-                            markdown_text = str(df2.to_markdown())
-                            text = f"##### {sheet} \n " + markdown_text
-
-                            if any(char.isdigit() for char in sheet):
-                                print(sheet)
-                                result = ''.join([char for char in sheet if not char.isdigit()])
-                                if result in sheets_data:
-                                    temp_data = sheets_data[result] + "\n\n" + text
-                                    sheets_data[result] = temp_data
-                                else:
-                                    sheets_data[result] = text
-                            else:
-                                sheets_data[sheet] = text
-                            logging.debug(f"Extracted data from sheet: {sheet}")
-                        except Exception as e:
-                            logging.error(f"Error processing sheet {sheet}: {e}")
-                            raise
+            sheets_data = {}
+            # Sheet tables are written to disk; the graph state only carries their paths
+            sheets_dir = os.path.join(self.output_path, ".sheets")
+            os.makedirs(sheets_dir, exist_ok=True)
+
+            for sheet in target:
+                logging.debug(f"Processing sheet: {sheet}")
+                try:
+                    df = frames[sheet]
+                    # Drop all-empty rows and blank out NaNs in one pass over the values
+                    mask = df.notna().any(axis=1)
+                    rows = df.loc[mask].to_numpy(dtype=object, na_value='')
+                    markdown_text = _to_md(df.columns, rows)
+                    text = f"##### {sheet} \n " + markdown_text
+
+                    # Numbered continuation sheets are appended to their base sheet's file
+                    base = base_names[sheet]
+                    if base in sheets_data:
+                        with open(sheets_data[base], "a", encoding="utf-8") as f:
+                            f.write("\n\n" + text)
+                    else:
+                        sheets_data[base] = os.path.join(sheets_dir, f"{base}.md")
+                        with open(sheets_data[base], "w", encoding="utf-8") as f:
+                            f.write(text)
+                    logging.debug(f"Extracted data from sheet: {sheet}")
+                except Exception as e:
+                    logging.error(f"Error processing sheet {sheet}: {e}")
+                    raise
 
             result = {"sheets_data": sheets_data, "sheets_to_analyze": list(sheets_data.keys())}
-            logging.debug(f"Result of extract_text_from_excel: {result}")
+            logging.debug("Result of extract_text_from_excel: %s", result)
             logging.info("Finished extract_text_from_excel")
             return result
 
@@ -136,134 +380,102 @@ class CMAAnalyzer:
             str: The sheet-specific prompt.
         """
         logging.info(f"Generating prompt for sheet: {sheet_name}")
-        prompts = {
-            "Profit & Loss Statement": dedent(f"""Analyze this Profit & Loss Statement data and provide key insights:
-
-            Key metrics that should be monitored in a Profit and Loss (P&L) Statement :
-                1. Revenue/Sales: Assess total revenue, breaking it down by product lines or business segments. Consider growth trends and seasonal variations.
-                2. Cost of Goods Sold (COGS): Analyze direct production costs. Discuss efficiency in managing production costs and its impact on profit margins. 
-                3. Calculate and assess gross profit margin: Gross Profit Margin = (Gross Profit / Revenue), which helps to metric reveals how well the company is managing its production costs relative to its sales.
-                4. Operating Expenses: Review operating expenses, including SG&A, R&D, and marketing. Assess the balance in spending.
-                5. Operating Income (EBIT): Analyze operating income (Earnings Before Interest and Taxes) and its trend. Determine operational efficiency excluding interest and taxes.
-                6. Operating Profit Margin: Calculate operating profit margin: Operating Profit Margin = (EBIT/Revenue)
-                7. Net Income: Review net income (bottom line) reflecting total profitability after all expenses. Assess overall financial health.
-                8. Net Profit Margin: Calculate net profit margin:  Net Profit Margin = (Net Income / Revenue)
-                9. Earnings Per Share (EPS): If applicable, analyze EPS to evaluate profit per outstanding share. Compare EPS trends over time.
-                10. EBITDA: Evaluate Earnings Before Interest, Taxes, Depreciation, and Amortization as a measure of operational performance and cash flow generation.
-                11. Depreciation and Amortization: Examine the impact of depreciation and amortization on net income, especially for capital-intensive companies.
-                12. Interest Expense: Review the cost of debt and its effect on profitability. High interest expenses may indicate over-leverage.
-                13. Tax Expense: Assess tax liability and its impact on net income. Look for changes in tax rates or strategies.
-                14. EBIT to EBITDA Conversion: Understand the relationship between EBIT and EBITDA and how non-cash expenses (depreciation, amortization) affect profitability.
-            """),
-
-            "Balance Sheet": dedent(f"""
-            Analyze this Balance Sheet to assess the financial health and stability of a company. Focus on key financial metrics, including liquidity, solvency, profitability, 
-            and efficiency. Examine trends in assets, liabilities, and equity to evaluate the company’s leverage, working capital, and overall financial position. Identify any 
-            risks or red flags, such as liquidity shortages, excessive debt, or declining asset value. Provide insights into how these financial metrics align with business 
-            performance and long-term sustainability. 
-
-            Key Metrics to Monitor in Balance Sheet Analysis:
-
-            - Liquidity Ratios (Short-term Financial Health):
-                 -- Current Ratio: Current Assets / Current Liabilities. Measures the ability to cover short-term obligations.
-                 -- Quick Ratio (Acid-Test Ratio): (Current Assets - Inventory) / Current Liabilities. A more stringent liquidity measure.
-                 -- Working Capital: Current Assets - Current Liabilities. Indicates operational liquidity.
-            - Solvency Ratios (Long-term Financial Stability):
-                 -- Debt-to-Equity Ratio: Total Debt / Total Equity. Measures financial leverage.
-                 -- Interest Coverage Ratio: EBIT / Interest Expense. Ability to service debt.
-            - Asset Management & Efficiency Ratios:
-                 -- Return on Assets (ROA): Net Income / Total Assets. Efficiency in using assets to generate profit.
-                 -- Fixed Asset Turnover: Revenue / Fixed Assets. Effectiveness in utilizing fixed assets.
-            - Profitability Indicators:
-                 -- Return on Equity (ROE): Net Income / Shareholder’s Equity. Profitability from shareholder investment.
-                 -- Gross Profit Margin: (Revenue - COGS) / Revenue. Measures core business profitability.
-            - Capital Structure & Leverage Analysis:
-                 -- Equity Ratio: Shareholder’s Equity / Total Assets. Indicates the proportion of assets financed by equity.
-                 -- Debt Ratio: Total Debt / Total Assets. Shows the percentage of assets financed by debt.
-            - Cash & Reserves Analysis:       
-                 -- Cash and Cash Equivalents: Assess liquidity reserves.
-                 -- Retained Earnings: Evaluate profit reinvestment for growth.
-            """),
-
-            "Fund Flow": dedent(f"""
-            Analyze the key metrics that should be monitored in a Fund Flow Statement. The goal is to identify the most relevant 
-            financial metrics and ratios that provide insights into the movement of funds within a business or organization. 
-            Focus on the major inflows and outflows, their sources, and how they impact cash liquidity, profitability, and the 
-            company's financial health.
-
-            Be sure to discuss the following:
-
-            1. Net Cash Flow: Determine whether the company has a positive or negative net cash flow and the implications of this for the business.
-            2. Operating Cash Flow: Analyze cash generated or used by the company's core operating activities. Consider whether the company is effectively converting its income into cash.
-            3. Investing Cash Flow: Identify significant capital expenditures or investments in assets, as well as proceeds from asset sales.
-            4. Financing Cash Flow: Evaluate cash movements from activities like issuing or repaying debt, issuing equity, or paying dividends.
-            5. Liquidity Position: Assess the company's liquidity based on available cash and equivalents, and how this affects its ability to meet short-term obligations.
-            6. Working Capital: Review changes in working capital, such as increases or decreases in accounts receivable, inventory, and accounts payable, and their impact on cash flow.
-            7. Free Cash Flow: Calculate and analyze the company’s ability to generate cash after capital expenditures.
-            8. Debt Service: Review the company’s ability to meet its debt obligations, including principal and interest payments.
-            9. Cash Flow from Operations to Net Income: Compare operating cash flow to net income, checking for discrepancies that might suggest non-cash adjustments.
-
-        Fund Flow Statement Analysis Template
-        1. Introduction 
-            - Brief overview of the company's financial position. 
-            - Purpose of the Fund Flow Statement analysis. 
-            - Key observations on fund movements.
-        2. Sources of Funds 
-            (List out major sources of funds and their impact) 
-            Source | Amount ($) | Remarks
-            Net Profit (After Tax) | XXX | Indicates earnings available for reinvestment.
-            Depreciation & Amortization| XXX | Non-cash expense added back as a source of funds.
-            Sale of Fixed Assets | XXX | Liquidation of assets generating cash inflow.
-            Issuance of Shares | XXX | Equity capital raised from investors.
-            Loan Borrowings | XXX | New debt raised for business expansion.
-            Other Inflows | XXX | Miscellaneous sources of funds.
-        3. Application (Uses) of Funds 
-           (List out major uses of funds and their impact) 
-            | **Use**                        | **Amount ($)** | **Remarks**                                      |
-            |--------------------------------|----------------|--------------------------------------------------|
-            | Capital Expenditures           | XXX            | Investment in new assets, expansion projects.    |
-            | Loan Repayment                 | XXX            | Debt reduction, improves solvency.               |
-            | Dividend Payments              | XXX            | Returns given to shareholders.                   |
-            | Increase in Working Capital    | XXX            | Indicates operational fund usage.                |
-            | Purchase of Investments        | XXX            | Investment or strategic acquisitions.            |
-            | Other Outflows                 | XXX            | Miscellaneous fund applications.                 |
-        4. Changes in Working Capital 
-            Increase in Current Assets (e.g., Inventory, Accounts Receivable) → Uses of funds. 
-            Increase in Current Liabilities (e.g., Payables, Short-term Debt) → Sources of funds. 
-            Net Change in Working Capital: Positive or negative impact on liquidity.
-        5. Fund Flow from Different Activities
-            | **Activity Type**        | **Net Inflow/Outflow ($)** | **Remarks**                                |
-            |--------------------------|----------------------------|--------------------------------------------|
-            | Operating Activities     | XXX                        | Profitability and core business cash flow. |
-            | Investing Activities     | XXX                        | Asset purchases/sales impact.              |
-            | Financing Activities     | XXX                        | Debt and equity transactions.              |
-        6. Liquidity & Financial Stability Assessment 
-            Cash Flow Sufficiency: Can the company meet short-term and long-term obligations? 
-            Debt-Equity Ratio Impact: Does fund movement improve or worsen financial leverage? 
-            Overall Business Strategy Alignment: Are fund flows supporting business growth? 
-        7. Key Insights & Recommendations 
-            Identify positive trends (e.g., strong cash inflows, reduced debt, improved working capital). 
-            Highlight risk factors (e.g., declining liquidity, excessive debt, negative working capital). 
-            Suggest strategic actions to optimize fund management
-            """),
-        }
-
-        default_prompt = f"""
-        Analyze this financial data from the '{sheet_name}' sheet and provide key insights:
-
-        {data_str}
-
-        Please include:
-        1. Key trends and patterns
-        2. Notable anomalies or concerns
-        3. Actionable recommendations
-        4. Important metrics to monitor
-        5. Overall assessment
+        return SHEET_PROMPTS.get(sheet_name) or DEFAULT_SHEET_PROMPT.format(sheet_name=sheet_name, data_str=data_str)
+
+    def _marshal_batch(self, sheets: List[Tuple[str, str]]) -> str:
         """
+        Combines several sheets into one user message, each with its own instructions and data.
+
+        Args:
+            sheets (List[Tuple[str, str]]): (sheet_name, data_str) pairs.
 
-        prompt = prompts.get(sheet_name, default_prompt)
-        # logging.debug(f"Generated prompt: {prompt}")
-        return prompt
+        Returns:
+            str: The delimited sheet sections.
+        """
+        return "\n\n".join(
+            f"=== SHEET: {sheet_name} ===\n{self.get_sheet_specific_prompt(sheet_name, data_str)}\n{data_str}\n=== END ==="
+            for sheet_name, data_str in sheets
+        )
+
+    def _analyze_marshaled(self, sheets_data: Dict[str, str], sheets_to_analyze: List[str]) -> Dict[str, str]:
+        """
+        Analyzes sheets in groups of sheets_per_call, one LLM call per group.
+
+        Args:
+            sheets_data (Dict[str, str]): Sheet Markdown file paths keyed by sheet name.
+            sheets_to_analyze (List[str]): The sheets to analyze.
+
+        Returns:
+            Dict[str, str]: Analyses returned by the model, keyed by sheet name.
+        """
+        groups = [sheets_to_analyze[i:i + self.sheets_per_call]
+                  for i in range(0, len(sheets_to_analyze), self.sheets_per_call)]
+        inputs = [{"system": self.system_message + MARSHALED_SHEETS_INSTRUCTIONS,
+                   "data": self._marshal_batch([(sheet_name, Path(sheets_data[sheet_name]).read_text(encoding="utf-8"))
+                                                for sheet_name in group])}
+                  for group in groups]
+        logging.info(f"Invoking LLM chain for {len(sheets_to_analyze)} sheets in {len(groups)} combined calls")
+        results = self.marshaled_chain.batch(inputs, config={"max_concurrency": self.max_concurrency},
+                                             return_exceptions=True)
+
+        insights = {}
+        for group, result in zip(groups, results):
+            if isinstance(result, Exception) or not isinstance(result, dict):
+                logging.warning(f"Combined analysis failed for sheets {group}: {result}")
+                continue
+            insights.update({sheet_name: result[sheet_name] for sheet_name in group
+                             if isinstance(result.get(sheet_name), str)})
+        return insights
+
+    def _count_tokens(self, text: str) -> int:
+        """Counts tokens with tiktoken, falling back to a generic encoding for non-OpenAI models."""
+        if self._token_encoding is None:
+            import tiktoken
+            try:
+                self._token_encoding = tiktoken.encoding_for_model(
+                    getattr(self.llm, "model_name", None) or getattr(self.llm, "model", ""))
+            except KeyError:
+                self._token_encoding = tiktoken.get_encoding("o200k_base")
+        return len(self._token_encoding.encode(text, disallowed_special=()))
+
+    @staticmethod
+    def _split_rows(data_str: str, parts: int) -> List[str]:
+        """Splits sheet data on line boundaries into parts of roughly equal length."""
+        target = len(data_str) / parts
+        chunks, current, size = [], [], 0
+        for line in data_str.splitlines(keepends=True):
+            if current and size + len(line) > target and len(chunks) < parts - 1:
+                chunks.append("".join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line)
+        chunks.append("".join(current))
+        return chunks
+
+    def _analyze_in_parts(self, sheet_name: str, system: str, data_str: str) -> str:
+        """
+        Map-reduce analysis for a sheet over sheet_token_budget: the row parts are analyzed concurrently,
+        then one more call combines the partial analyses.
+
+        Args:
+            sheet_name (str): The name of the sheet.
+            system (str): The system message with the sheet's instructions; must not embed the sheet data.
+            data_str (str): The sheet data.
+
+        Returns:
+            str: The combined analysis.
+        """
+        # Each part is sent with the system message, so only the rest of the budget is left for rows
+        data_tokens = self._count_tokens(data_str)
+        data_budget = max(self.sheet_token_budget - self._count_tokens(system), 1)
+        chunks = self._split_rows(data_str, math.ceil(data_tokens / data_budget))
+        logging.info(f"Sheet {sheet_name} has {data_tokens} tokens; analyzing it in {len(chunks)} parts")
+        partials = self.sheet_chain.batch(
+            [{"system": system + SHEET_PART_INSTRUCTIONS.format(part=i, parts=len(chunks)), "data": chunk}
+             for i, chunk in enumerate(chunks, start=1)],
+            config={"max_concurrency": self.max_concurrency})
+        combined = "\n\n".join(f"### Part {i}\n\n{partial}" for i, partial in enumerate(partials, start=1))
+        return self.sheet_chain.invoke({"system": system + COMBINE_PARTS_INSTRUCTIONS, "data": combined})
 
     def analyze_sheets(self, state: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -280,45 +492,51 @@ class CMAAnalyzer:
         sheets_to_analyze = state["sheets_to_analyze"]
         logging.debug(f"Sheets to analyze: {sheets_to_analyze}")
         insights = {}
+        if self.sheets_per_call > 1 and len(sheets_to_analyze) > 1:
+            insights = self._analyze_marshaled(sheets_data, sheets_to_analyze)
 
+        # Sheets not covered by a combined call get their own call
+        remaining = []
+        inputs = []
         for sheet_name in sheets_to_analyze:
-            logging.info(f"Analyzing sheet: {sheet_name}")
+            if sheet_name in insights:
+                continue
+            data_str = Path(sheets_data[sheet_name]).read_text(encoding="utf-8")
+            prompt = self.get_sheet_specific_prompt(sheet_name, data_str)
+            # %-style: the prompt is only formatted when DEBUG is enabled
+            logging.debug("Prompt for %s: %s", sheet_name, prompt)
+            # Sheets whose full request (system message and data) is over the context budget are split
+            # rather than sent and rejected
+            tokens = self._count_tokens(self.system_message + prompt) + self._count_tokens(data_str)
+            if tokens > self.sheet_token_budget:
+                # The fallback prompt embeds the data; each part must carry only its own rows
+                part_prompt = self.get_sheet_specific_prompt(sheet_name, "")
+                try:
+                    insights[sheet_name] = self._analyze_in_parts(sheet_name, self.system_message + part_prompt,
+                                                                  data_str)
+                except Exception as e:
+                    logging.error(f"Error analyzing sheet {sheet_name}: {e}")
+                    raise
+                continue
+            remaining.append(sheet_name)
+            inputs.append({"system": self.system_message + prompt, "data": data_str})
+
+        # All sheets are sent at once (up to max_concurrency); each call only waits on the provider
+        if inputs:
+            logging.info(f"Invoking LLM chain for {len(inputs)} sheets")
             try:
-                sheet_data = sheets_data[sheet_name]
-                data_str = sheet_data
-
-                prompt = self.get_sheet_specific_prompt(sheet_name, data_str)
-                logging.debug(f"Prompt for {sheet_name}: {prompt}")
-
-                system = self.system_message + prompt
-
-                print(system)
-
-                print(data_str)
-
-                chain = (
-                        ChatPromptTemplate.from_messages([
-                            ("system", system),
-                            ("human", data_str)
-                        ])
-                        | self.llm
-                        | self.output_parser
-                )
-
-                logging.info(f"Invoking LLM chain for sheet: {sheet_name}")
-                result = chain.invoke({})
-                logging.debug(f"LLM result for {sheet_name}: {result}")
-
-                output_file_path = os.path.join(self.output_path, f"{sheet_name}.md")
-                with open(output_file_path, "w") as f:  # Use "w" to overwrite existing files
-                    f.write(result)
-                logging.info(f"Analysis for {sheet_name} saved to {output_file_path}")
-
-                insights[sheet_name] = result
-
+                results = self.sheet_chain.batch(inputs, config={"max_concurrency": self.max_concurrency})
             except Exception as e:
-                logging.error(f"Error analyzing sheet {sheet_name}: {e}")
+                logging.error(f"Error analyzing sheets {remaining}: {e}")
                 raise
+            insights.update(zip(remaining, results))
+
+        for sheet_name, result in insights.items():
+            logging.debug("LLM result for %s: %s", sheet_name, result)
+            output_file_path = os.path.join(self.output_path, f"{sheet_name}.md")
+            with open(output_file_path, "w") as f:  # Use "w" to overwrite existing files
+                f.write(result)
+            logging.info(f"Analysis for {sheet_name} saved to {output_file_path}")
 
         logging.info("Finished analyze_sheets")
         return {"insights": insights}
@@ -352,16 +570,17 @@ class CMAAnalyzer:
         """
         logging.info(f"Starting CMA analysis for file: {excel_file_path}")
         try:
-            app = self.create_langgraph_workflow()
+            if self._app is None:
+                self._app = self.create_langgraph_workflow()
             initial_state = {"excel_file_path": excel_file_path,
                              "insights": {},
                              "sheets_data": {},
                              "output_path": self.output_path,
                              "sheets_to_analyze": []}
-            logging.debug(f"Initial state: {initial_state}")
+            logging.debug("Initial state: %s", initial_state)
 
             logging.info("Invoking LangGraph workflow")
-            app.invoke(initial_state)
+            self._app.invoke(initial_state)
             logging.info("LangGraph workflow completed successfully")
 
         except Exception as e: